@@ -2,13 +2,15 @@ import pandas as pd
 import numpy as np
 from sklearn import preprocessing
 from time import time
-from datetime import datetime, timedelta
+from datetime import datetime
 import os
-from collections import namedtuple
+import weakref
+import threading
+from collections import namedtuple, OrderedDict
 
 import tensorflow as tf
 from keras import backend as K
-from keras.callbacks import TensorBoard, EarlyStopping
+from keras.callbacks import TensorBoard, EarlyStopping, History
 
 
 from config import (
@@ -16,7 +18,9 @@ from config import (
     onCluster,
     useEarlyStopping,
     cd_of_quotes_to_consider_for_vol_surf,
-    option_type
+    option_type,
+    data_package_cache_mb,
+    gradient_batch_size
 )
 
 from data import (
@@ -25,7 +29,9 @@ from data import (
     synth
 )
 
-from models import black_scholes_pricer
+from models import black_scholes_pricer, restore_initial_weights, export_ensemble_member
+from dataset_store import read_dataset_window
+from vol_surface import bilinear_vsurface_interpolation_batch
 
 
 def timeit(method):
@@ -55,6 +61,60 @@ def get_data_for_single_stock_and_day(sorted_set, stock, daterange):
     return single_stock_multiple_days_single_df
 
 
+class DataWindowIndex:
+    """
+    Row order of the dataset by (permno, date) together with the row range of every stock,
+    so that a stock/window is located with searchsorted without keeping a sorted copy of the dataset
+    """
+    def __init__(self, df):
+        dates = df.index.get_level_values(0).values
+        stocks = np.asarray(df.index.get_level_values(1))
+
+        # lexsort is stable, rows of the same stock and date keep their order from df
+        order = np.lexsort((dates, stocks))
+        self.df = df
+        # A dataset already sorted by (permno, date) is sliced directly
+        self.order = None if (np.diff(order) == 1).all() else order
+        self.dates = dates if self.order is None else dates[order]
+
+        unique_stocks, starts = np.unique(stocks[order], return_index=True)
+        ends = np.append(starts[1:], len(order))
+        self.stock_ranges = {stock: (start, end) for stock, start, end in zip(unique_stocks, starts, ends)}
+
+    def get_rows(self, start, end):
+        if self.order is None:
+            return self.df.iloc[start:end]
+        return self.df.iloc[self.order[start:end]]
+
+    def get_window(self, stock, start_date, end_train_start_val_date, end_val_date):
+        first, last = self.stock_ranges.get(stock, (0, 0))
+        bounds = [pd.Timestamp(date).to_datetime64() for date in (start_date, end_train_start_val_date, end_val_date)]
+        start, middle, end = np.searchsorted(self.dates[first:last], bounds, side='left') + first
+        return self.get_rows(start, middle), self.get_rows(middle, end)
+
+
+window_index = None
+
+
+def build_window_index():
+    global window_index
+    if dataset is not None and window_index is None:
+        window_index = DataWindowIndex(dataset)
+
+
+def get_window_rows(stock, start_date, end_train_start_val_date, end_val_date, columns):
+    if dataset is None:
+        # Only the partitions of this stock and window are read, restricted to the requested columns
+        source = read_dataset_window(stock, start_date, end_val_date, columns=columns)
+        dates = source.index.get_level_values(0)
+        train = source.loc[dates < end_train_start_val_date]
+        validate = source.loc[dates >= end_train_start_val_date]
+    else:
+        build_window_index()
+        train, validate = window_index.get_window(stock, start_date, end_train_start_val_date, end_val_date)
+    return train, validate
+
+
 def get_data_window(start_date='2010-01-01',
                     end_train_start_val_date='2010-06-30',
                     end_val_date='2010-12-31',
@@ -65,15 +125,9 @@ def get_data_window(start_date='2010-01-01',
         input_columns = ['days', 'moneyness']
     if output_columns is None:
         output_columns = ['scaled_option_price']
-    dates = dataset.index.get_level_values(0)
-    stocks = dataset.index.get_level_values(1)
 
-    idx_stock = stocks == stock
-    idx_train = (dates >= start_date) & (dates < end_train_start_val_date)
-    idx_validate = (dates >= end_train_start_val_date) & (dates < end_val_date)
-
-    train = dataset.loc[idx_train & idx_stock]
-    validate = dataset.loc[idx_validate & idx_stock]
+    columns = list(dict.fromkeys(input_columns + output_columns))
+    train, validate = get_window_rows(stock, start_date, end_train_start_val_date, end_val_date, columns)
 
     X_train = train[input_columns]
     Y_train = train[output_columns]
@@ -85,13 +139,7 @@ def get_data_window(start_date='2010-01-01',
     return data
 
 
-def get_data_package(model, columns=None, include_synth=False, normalize='no',
-                     start_date='2010-01-01',
-                     end_train_start_val_date='2010-06-30',
-                     end_val_date='2010-12-31',
-                     stock=some_stock):
-    if columns is None:
-        columns = ['days', 'moneyness']
+def get_output_columns(model, columns):
     if model == 'BS':
         output_columns = ['scaled_option_price']
     elif model == 'BS_also_hedging':
@@ -106,23 +154,27 @@ def get_data_package(model, columns=None, include_synth=False, normalize='no',
             output_columns = ['scaled_option_price', 'perfect_hedge_1']
         else:
             output_columns = ['scaled_option_price']
+    return output_columns
+
+
+def get_data_package(model, columns=None, include_synth=False, normalize='no',
+                     start_date='2010-01-01',
+                     end_train_start_val_date='2010-06-30',
+                     end_val_date='2010-12-31',
+                     stock=some_stock,
+                     output_columns=None):
+    if columns is None:
+        columns = ['days', 'moneyness']
+    if output_columns is None:
+        output_columns = get_output_columns(model, columns)
     # ref_columns = ['prc', 'option_price', 'strike_price', 'prc_shifted_1', 'option_price_shifted_1']
     ref_columns = ['prc', 'option_price', 'strike_price', 'prc_atExpiration', 'r', 'days']
 
-    data = get_data_window(
-        input_columns=columns,
-        output_columns=output_columns,
-        start_date=start_date,
-        end_train_start_val_date=end_train_start_val_date,
-        end_val_date=end_val_date,
-        stock=stock)
-    ref_data = get_data_window(
-        input_columns=ref_columns,
-        output_columns=output_columns,
-        start_date=start_date,
-        end_train_start_val_date=end_train_start_val_date,
-        end_val_date=end_val_date,
-        stock=stock)
+    # Features and reference columns are taken from the same slice of the dataset
+    window_columns = list(dict.fromkeys(columns + output_columns + ref_columns))
+    train, validate = get_window_rows(stock, start_date, end_train_start_val_date, end_val_date, window_columns)
+    data = train[columns], train[output_columns], validate[columns], validate[output_columns]
+    ref_data = train[ref_columns], train[output_columns], validate[ref_columns], validate[output_columns]
 
     if include_synth:
         X_synth = synth.loc[:, columns]
@@ -168,6 +220,81 @@ def get_data_package(model, columns=None, include_synth=False, normalize='no',
     return DataPackage(data, X_synth, Y_synth, ref_data, scaler_X, scaler_Y)
 
 
+def get_data_package_size(data_package):
+    frames = list(data_package.data) + list(data_package.ref_data) + [data_package.X_synth, data_package.Y_synth]
+    return sum(frame.memory_usage(index=True).sum() for frame in frames if frame is not None)
+
+
+class DataPackageCache:
+    """
+    LRU cache around get_data_package, bounded by the memory used by the cached DataPackages.
+    It may be filled from a background thread, a package that is still being prepared is waited for
+    """
+    def __init__(self, max_megabytes=data_package_cache_mb):
+        self.max_bytes = max_megabytes * 2**20
+        self.packages = OrderedDict()
+        self.sizes = {}
+        self.used_bytes = 0
+        self.hits = self.misses = self.evictions = 0
+        self.lock = threading.Lock()
+        self.loading = {}
+
+    def get_data_package(self, model, columns=None, include_synth=False, normalize='no',
+                         start_date='2010-01-01',
+                         end_train_start_val_date='2010-06-30',
+                         end_val_date='2010-12-31',
+                         stock=some_stock,
+                         output_columns=None):
+        if columns is None:
+            columns = ['days', 'moneyness']
+        if output_columns is None:
+            output_columns = get_output_columns(model, columns)
+        key = (stock, start_date, end_train_start_val_date, end_val_date, tuple(columns),
+               tuple(output_columns), include_synth, normalize)
+
+        while True:
+            with self.lock:
+                if key in self.packages:
+                    self.hits += 1
+                    self.packages.move_to_end(key)
+                    return self.packages[key]
+                loaded = self.loading.get(key)
+                if loaded is None:
+                    self.misses += 1
+                    loaded = self.loading[key] = threading.Event()
+                    break
+            # Prepared by another thread, unless it did not fit into the cache the next round is a hit
+            loaded.wait()
+
+        try:
+            data_package = get_data_package(model, columns=columns, include_synth=include_synth,
+                                            normalize=normalize, start_date=start_date,
+                                            end_train_start_val_date=end_train_start_val_date,
+                                            end_val_date=end_val_date, stock=stock, output_columns=output_columns)
+            size = get_data_package_size(data_package)
+            with self.lock:
+                if size <= self.max_bytes:
+                    self.packages[key] = data_package
+                    self.sizes[key] = size
+                    self.used_bytes += size
+                    while self.used_bytes > self.max_bytes:
+                        evicted_key, _ = self.packages.popitem(last=False)
+                        self.used_bytes -= self.sizes.pop(evicted_key)
+                        self.evictions += 1
+        finally:
+            with self.lock:
+                del self.loading[key]
+            loaded.set()
+        return data_package
+
+    def get_counters(self):
+        return self.hits, self.misses, self.evictions
+
+    def report(self):
+        msg = '{} packages using {:.1f} MB'
+        return msg.format(len(self.packages), self.used_bytes / 2**20)
+
+
 def get_hedging_errors(deltas, ref_data):
     if option_type == 'call':
         option_payout = (ref_data['prc_atExpiration'] - ref_data.strike_price).clip(lower=0)
@@ -197,7 +324,7 @@ def get_hedging_errors(deltas, ref_data):
 
 def run_and_store_ann(model, in_sample=False, reset='yes', nb_epochs=5, data_package=None, verbose=0,
                       model_name='custom', columns=None, get_deltas=False, include_synth=False, normalize='no',
-                      batch_size=25, starting_time_str=None):
+                      batch_size=25, starting_time_str=None, store_output=True, trained_history=None):
     if columns is None:
         columns = ['days', 'moneyness']
     if data_package is None:
@@ -206,6 +333,9 @@ def run_and_store_ann(model, in_sample=False, reset='yes', nb_epochs=5, data_pac
     else:
         data, X_synth, Y_synth, ref_data_tuple, scaler_X, scaler_Y = data_package
 
+    # A model trained elsewhere, e.g. a member of run_ensemble, is only evaluated, together with its history
+    if trained_history is not None:
+        reset = 'reuse'
     loss, Y_prediction, history = run(model,
                                       data=data,
                                       # sample_size = 10000,
@@ -220,6 +350,9 @@ def run_and_store_ann(model, in_sample=False, reset='yes', nb_epochs=5, data_pac
                                       in_sample=in_sample,
                                       batch_size=batch_size,
                                       starting_time_str=starting_time_str)
+    if trained_history is not None:
+        history = trained_history
+        loss = history.history['loss']
     last_loss = loss[-1]
     if history is not None:
         loss = history.history['loss']
@@ -295,35 +428,37 @@ def run_and_store_ann(model, in_sample=False, reset='yes', nb_epochs=5, data_pac
     sample["scaled_option_price"] = target.scaled_option_price
     sample["error"] = sample.scaled_option_price - sample.prediction
 
-    with pd.HDFStore(paths['neural_net_output']) as store:
-        store_model_architecture = False
-        store_model_losses_throughout_training = False
-        store_primitive_performance_metrics = True
-        if store_model_architecture:
-            if '/model_architectures' in store.keys():
-                model_architectures = store['/model_architectures']
-            else:
-                model_architectures = pd.DataFrame(columns=['models'])
-            if not model_name.startswith('rational_'):
-                model_architectures.loc[model_name] = model.to_json()
-            store['/model_architectures'] = model_architectures
-        if store_model_losses_throughout_training:
-            if reset != 'reuse':
-                lossDF = pd.DataFrame(loss, columns=[model_name])
-                if '/model_losses' in store.keys():
-                    model_losses = store['/model_losses']
-                    model_losses_new = lossDF.combine_first(model_losses)
+    # Workers return the output instead, only the main process opens the shared store
+    if store_output:
+        with pd.HDFStore(paths['neural_net_output']) as store:
+            store_model_architecture = False
+            store_model_losses_throughout_training = False
+            store_primitive_performance_metrics = True
+            if store_model_architecture:
+                if '/model_architectures' in store.keys():
+                    model_architectures = store['/model_architectures']
                 else:
-                    model_losses_new = lossDF
-                store['/model_losses'] = model_losses_new
-        if store_primitive_performance_metrics:
-            store[model_name] = sample
+                    model_architectures = pd.DataFrame(columns=['models'])
+                if not model_name.startswith('rational_'):
+                    model_architectures.loc[model_name] = model.to_json()
+                store['/model_architectures'] = model_architectures
+            if store_model_losses_throughout_training:
+                if reset != 'reuse':
+                    lossDF = pd.DataFrame(loss, columns=[model_name])
+                    if '/model_losses' in store.keys():
+                        model_losses = store['/model_losses']
+                        model_losses_new = lossDF.combine_first(model_losses)
+                    else:
+                        model_losses_new = lossDF
+                    store['/model_losses'] = model_losses_new
+            if store_primitive_performance_metrics:
+                store[model_name] = sample
 
     # if len(loss)> 0:
     #     success = loss[-1] < required_precision
     # else: success = True
-    ANNResult = namedtuple('ANNResult', 'history last_loss loss_tuple MSHE MAPHE')
-    return ANNResult(history, last_loss, loss_tuple, MSHE, MAPHE)
+    ANNResult = namedtuple('ANNResult', 'history last_loss loss_tuple MSHE MAPHE output')
+    return ANNResult(history, last_loss, loss_tuple, MSHE, MAPHE, sample)
 
 
 class TrainValTensorBoard(TensorBoard):
@@ -437,7 +572,7 @@ def run(model,
     validation_data = (X_val, Y_val)
 
     if reset == 'yes':
-        model.load_weights(paths['weights'])
+        restore_initial_weights(model)
 
     if reset != 'reuse':
         history = model.fit(X_train, Y_train, batch_size=batch_size, epochs=nb_epochs, verbose=verbose,
@@ -480,46 +615,147 @@ def run(model,
     return loss, Y_prediction, history
 
 
-def get_input_gradients_at_point(model, point):
-    outputTensor = model.output
-    listOfInputs = model.inputs
-    gradients = K.gradients(outputTensor, listOfInputs)
+def stack_data_packages(data_packages, validation=False, seed=None):
+    """
+    Aligns the data of several DataPackages row by row to (rows, members, columns) arrays for ensemble_model.
+    The targets are followed by the sample weight of the row, members with less rows are filled up with
+    repeated rows of weight 0, which do not count towards their loss
+    """
+    X_position, Y_position = (2, 3) if validation else (0, 1)
+    random_state = np.random.RandomState(seed)
+    rows = max(len(package.data[X_position]) for package in data_packages)
+    X_stacked = []
+    Y_stacked = []
+    for package in data_packages:
+        X, Y = package.data[X_position].values, package.data[Y_position].values
+        index = np.concatenate([random_state.permutation(len(X)), random_state.randint(len(X), size=rows - len(X))])
+        weight = (np.arange(rows) < len(X)).astype(Y.dtype)
+        X_stacked.append(X[index])
+        Y_stacked.append(np.column_stack([Y[index], weight]))
+    return np.stack(X_stacked, axis=1), np.stack(Y_stacked, axis=1)
+
+
+def run_ensemble(ensemble, data_packages, architecture, nb_epochs=5, batch_size=25, verbose=0, seed=None):
+    """
+    Trains an ensemble_model with one member per DataPackage, and returns the members as separate full_models
+    together with their histories. They are evaluated like any other model, e.g. with run_and_store_ann
+    """
+    X_train, Y_train = stack_data_packages(data_packages, seed=seed)
+    validation_data = stack_data_packages(data_packages, validation=True, seed=seed)
+    history = ensemble.fit(X_train, Y_train, batch_size=batch_size, epochs=nb_epochs, verbose=verbose,
+                           validation_data=validation_data)
+    members = []
+    member_histories = []
+    for member in range(len(data_packages)):
+        members.append(export_ensemble_member(ensemble, member, **architecture))
+        member_history = History()
+        member_history.history = {'loss': history.history['member_{}_loss'.format(member)],
+                                  'val_loss': history.history['val_member_{}_loss'.format(member)]}
+        member_histories.append(member_history)
+    return members, member_histories
 
-    sess = K.get_session()
-    evaluated_gradients = sess.run(gradients, feed_dict={model.input: np.array([point])})
-    return evaluated_gradients[0][0]
 
+gradient_functions = weakref.WeakKeyDictionary()
 
-def extract_deltas(model, inputs, strikes):
-    outputTensor = model.output
-    listOfInputs = model.inputs
-    gradients = K.gradients(outputTensor, listOfInputs)
 
+def get_gradient_function(model):
+    # Built once per model, calling K.gradients for every evaluation keeps adding ops to the graph
+    if model not in gradient_functions:
+        gradients = K.gradients(model.output, model.inputs)
+        gradient_functions[model] = K.function(model.inputs, gradients)
+    return gradient_functions[model]
+
+
+def get_input_gradients_at_point(model, point):
+    return get_gradients(model, np.array([point]))[0]
+
+
+def extract_deltas(model, inputs, strikes):
     moneyness_loc = inputs.columns.get_loc('moneyness')
 
-    sess = K.get_session()
-    gradients_of_individual_inputs = sess.run(gradients, feed_dict={model.input: np.array(inputs)})[0]
-    moneyness_derivative = pd.Series([gradients_row[moneyness_loc] for gradients_row in gradients_of_individual_inputs])
-    moneyness_derivative.index = strikes.index
+    gradients_of_individual_inputs = get_gradients(model, inputs)
+    moneyness_derivative = pd.Series(gradients_of_individual_inputs[:, moneyness_loc], index=strikes.index)
     deltas = moneyness_derivative
     return deltas
 
 
-def get_gradients(model, inputs):
-    outputTensor = model.output
-    listOfInputs = model.inputs
-    gradients = K.gradients(outputTensor, listOfInputs)
-    sess = K.get_session()
-    gradients_of_individual_inputs = sess.run(gradients, feed_dict={model.input: np.array(inputs)})[0]
+def get_gradients(model, inputs, batch_size=gradient_batch_size):
+    gradient_function = get_gradient_function(model)
+    inputs = np.array(inputs)
+    gradients_of_individual_inputs = np.empty(inputs.shape, dtype=np.float32)
+    for start in range(0, len(inputs), batch_size):
+        batch = inputs[start:start + batch_size]
+        gradients_of_individual_inputs[start:start + len(batch)] = gradient_function([batch])[0]
     return gradients_of_individual_inputs
 
 
+def get_gradients_data(model, samples, scaler_X, model_name, time, stock, dt_start, runID):
+    """
+    Long format table with one row per point and feature of every sample,
+    built from the gradient matrix at once instead of row by row
+    """
+    frames = []
+    for sample_key, points in samples.items():
+        gradients = get_gradients(model, points)
+        rescaled = scaler_X.inverse_transform(points)
+        num_points, num_features = rescaled.shape
+        moneyness = rescaled[:, points.columns.get_loc('moneyness')]
+
+        # feature-major order: all points of the first feature, then all points of the second, ...
+        frames.append(pd.DataFrame({
+            'model_name': model_name,
+            'time': time,
+            'sample': sample_key,
+            'feature': np.repeat(np.array(points.columns), num_points),
+            'feature_value': rescaled.T.ravel(),
+            'gradient': gradients.T.ravel(),
+            'stock': stock,
+            'dt_start': dt_start,
+            'runID': runID,
+            'num_features': num_features,
+            'moneyness': np.tile(moneyness, num_features)
+        }))
+    return pd.concat(frames, ignore_index=True)
+
+
 def get_ssd(model, inputs):
     gradients_of_individual_inputs = get_gradients(model, inputs)
     SSD = np.square(gradients_of_individual_inputs).mean(axis=0)
     return SSD
 
 
+class VolSurfaceIndex:
+    """
+    Quotes of a single stock ordered by date. The quotes of the trailing
+    cd_of_quotes_to_consider_for_vol_surf calendar days that make up the volatility surface
+    of a trading day are sliced once, cached, and used for all quotes of that day
+    """
+    def __init__(self, quotes, lookback_days=cd_of_quotes_to_consider_for_vol_surf):
+        dates = quotes.index.get_level_values(0).values
+        order = np.argsort(dates, kind='mergesort')
+        self.quotes = quotes.iloc[order]
+        self.dates = dates[order]
+        self.lookback = np.timedelta64(lookback_days, 'D')
+        self.surfaces = {}
+
+    def get_surface(self, date):
+        if date not in self.surfaces:
+            # Quotes strictly between date - lookback and date
+            start = np.searchsorted(self.dates, date - self.lookback, side='right')
+            end = np.searchsorted(self.dates, date, side='left')
+            self.surfaces[date] = self.quotes.iloc[start:end]
+        return self.surfaces[date]
+
+    def interpolate(self, dates, ttms, moneyness):
+        vols = np.empty(len(dates))
+        unique_dates, inverse = np.unique(dates, return_inverse=True)
+        positions_by_date = np.split(np.argsort(inverse, kind='mergesort'), np.cumsum(np.bincount(inverse))[:-1])
+        for date, positions in zip(unique_dates, positions_by_date):
+            surface = self.get_surface(date)
+            vols[positions] = bilinear_vsurface_interpolation_batch(surface, ttms[positions], moneyness[positions])
+        return vols
+
+
 def run_black_scholes(data_package, in_sample=False, vol_proxy='hist_realized'):
 
     data = data_package.data
@@ -529,29 +765,24 @@ def run_black_scholes(data_package, in_sample=False, vol_proxy='hist_realized'):
     if in_sample:
         X_test, Y_test = X_train, Y_train
 
-    X_train.days = X_train.days / 365
-    X_test.days = X_test.days / 365
-
-    df = pd.concat([X_train, X_test])
-    dateIndex = df.index.get_level_values(0)
-
-    def bs_predict(point):
-        days, moneyness, hist_impl_volatility, v60, r = tuple(point)
-        date = point.name[0]
-        if vol_proxy == 'hist_implied':
-            vola = hist_impl_volatility
-        elif vol_proxy == 'hist_realized':
-            vola = v60
-        elif vol_proxy == 'surface':
-            idx = (dateIndex < date) & (dateIndex > date - timedelta(days=cd_of_quotes_to_consider_for_vol_surf))
-            relevant_quotes = df.loc[idx]
-            vola = bilinear_vsurface_interpolation(relevant_quotes, days, moneyness)
-        else:
-            raise ValueError
-        result = black_scholes_pricer(moneyness, days, r, vola, option_type)
-        return pd.Series(result, index=['price', 'delta'])
+    # The frames may be shared through the DataPackage cache, so they must not be modified in place
+    X_train = X_train.assign(days=X_train.days / 365)
+    X_test = X_test.assign(days=X_test.days / 365)
+
+    days, moneyness, hist_impl_volatility, v60, r = (X_test.iloc[:, k].values for k in range(5))
+    if vol_proxy == 'hist_implied':
+        vola = hist_impl_volatility
+    elif vol_proxy == 'hist_realized':
+        vola = v60
+    elif vol_proxy == 'surface':
+        surface_index = VolSurfaceIndex(pd.concat([X_train, X_test]))
+        vola = surface_index.interpolate(X_test.index.get_level_values(0).values, days, moneyness)
+    else:
+        raise ValueError
 
-    prediction = X_test.apply(bs_predict, axis=1)
+    # With the volatilities known for every quote, the whole window is priced in one call
+    price, delta = black_scholes_pricer(moneyness, days, r, vola, option_type)
+    prediction = pd.DataFrame({'price': price, 'delta': delta}, index=X_test.index)
     assert not prediction.isnull().any().any()
 
     results = X_test.copy()
@@ -570,70 +801,3 @@ def run_black_scholes(data_package, in_sample=False, vol_proxy='hist_realized'):
 
     BSResult = namedtuple('BSResult', 'MSE MAE MAPE MSHE MAPHE')
     return BSResult(MSE, MAE, MAPE, MSHE, MAPHE)
-
-
-def bilinear_vsurface_interpolation(quotes, ttm, mon):
-
-    quotes = quotes.sort_values('days', ascending=False)
-
-    later_than = quotes.loc[quotes.days <= ttm]
-    earlier_than = quotes.loc[quotes.days >= ttm]
-
-    if len(later_than) == 0:
-        later_than = earlier_than.sort_values('days', ascending=False).iloc[0]
-        interp_later = later_than.loc[['impl_volatility', 'days']]
-    else:
-        lower_than_later = later_than.loc[later_than.moneyness <= mon]
-        higher_than_later = later_than.loc[later_than.moneyness > mon]
-
-        if len(lower_than_later) == 0:
-            higher_than_later = higher_than_later.sort_values('moneyness', ascending=False).iloc[-1]
-            interp_later = higher_than_later.loc[['impl_volatility', 'days']]
-        elif len(higher_than_later) == 0:
-            lower_than_later = lower_than_later.sort_values('moneyness', ascending=False).iloc[0]
-            interp_later = lower_than_later.loc[['impl_volatility', 'days']]
-        else:
-            lower_than_later = lower_than_later.sort_values('moneyness', ascending=False).iloc[0]
-            higher_than_later = higher_than_later.sort_values('moneyness', ascending=False).iloc[-1]
-
-            later_ratio = (mon - lower_than_later.moneyness)/(higher_than_later.moneyness - lower_than_later.moneyness)
-            interp_later = (
-                    lower_than_later.loc[['impl_volatility', 'days']] * (1 - later_ratio)
-                    + higher_than_later.loc[['impl_volatility', 'days']] * later_ratio
-            )
-    if len(earlier_than) == 0:
-        earlier_than = later_than.sort_values('days', ascending=False).iloc[-1]
-        interp_earlier = earlier_than.loc[['impl_volatility', 'days']]
-    else:
-        lower_than_earlier = earlier_than.loc[earlier_than.moneyness <= mon]
-        higher_than_earlier = earlier_than.loc[earlier_than.moneyness > mon]
-
-        if len(lower_than_earlier) == 0:
-            higher_than_earlier = higher_than_earlier.sort_values('moneyness', ascending=False).iloc[-1]
-            interp_earlier = higher_than_earlier.loc[['impl_volatility', 'days']]
-        elif len(higher_than_earlier) == 0:
-            lower_than_earlier = lower_than_earlier.sort_values('moneyness', ascending=False).iloc[0]
-            interp_earlier = lower_than_earlier.loc[['impl_volatility', 'days']]
-        else:
-            lower_than_earlier = lower_than_earlier.sort_values('moneyness', ascending=False).iloc[0]
-            higher_than_earlier = higher_than_earlier.sort_values('moneyness', ascending=False).iloc[-1]
-
-            earlier_ratio = (mon - lower_than_earlier.moneyness) / (
-                        higher_than_earlier.moneyness - lower_than_earlier.moneyness)
-            interp_earlier = (
-                    lower_than_earlier.loc[['impl_volatility', 'days']] * (1 - earlier_ratio)
-                    + higher_than_earlier.loc[['impl_volatility', 'days']] * earlier_ratio
-            )
-
-    if interp_later.days == interp_earlier.days:
-        interp = interp_earlier.impl_volatility
-    else:
-        ratio = (ttm - interp_earlier.days) / (interp_later.days - interp_earlier.days)
-        if ratio > 1:
-            interp = interp_later.impl_volatility
-        elif ratio < 0:
-            interp = interp_earlier.impl_volatility
-        else:
-            interp = interp_earlier.impl_volatility * (1 - ratio) + interp_later.impl_volatility * ratio
-
-    return interp
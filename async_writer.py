@@ -0,0 +1,150 @@
+import os
+import queue
+import pickle
+import glob
+import shutil
+import threading
+import traceback
+from collections import namedtuple
+
+import pandas as pd
+
+from config import writer_queue_size
+
+# Results are persisted by a single background thread, so that training does not wait for the disk.
+# Nothing is changed in place: the outputs and gradients of every job go to a shard of their own,
+# e.g. ANN-output/<job_key>.h5 next to ANN-output.h5, and models and other files are written to a
+# temporary file first and then renamed, so an interrupted write never leaves a file half written.
+# Writes run in submission order and stop at the first failure, and store_training_result submits
+# the row that marks a job as complete in results.sqlite last, so resume_sweep redoes a job whose
+# writes were interrupted.
+
+stop_writing = None
+
+# What the writer needs to save a Keras model, taken on the training thread
+ModelSnapshot = namedtuple('ModelSnapshot', 'architecture weights')
+
+
+def update_hdf_safely(path, updates):
+    """
+    Applies updates to a copy of the store that then replaces it, only meant for small stores
+    """
+    temp_path = path + '.tmp'
+    if os.path.exists(path):
+        shutil.copyfile(path, temp_path)
+    elif os.path.exists(temp_path):
+        os.remove(temp_path)
+    with pd.HDFStore(temp_path, mode='a') as store:
+        for update in updates:
+            update(store)
+    os.replace(temp_path, path)
+
+
+def get_shard_dir(path):
+    return os.path.splitext(path)[0]
+
+
+def write_hdf_shard(path, name, updates):
+    """
+    Applies updates, functions taking an open HDFStore, to a new shard of the store at path
+    """
+    shard_path = os.path.join(get_shard_dir(path), name + '.h5')
+    os.makedirs(os.path.dirname(shard_path), exist_ok=True)
+    temp_path = shard_path + '.tmp'
+    with pd.HDFStore(temp_path, mode='w') as store:
+        for update in updates:
+            update(store)
+    os.replace(temp_path, shard_path)
+
+
+def read_hdf_shards(path, key):
+    """
+    Objects stored under key in the store at path, as written before there were shards, and in its
+    shards, in the order they were written
+    """
+    shard_paths = sorted(glob.glob(os.path.join(get_shard_dir(path), '*.h5')), key=os.path.getmtime)
+    objects = []
+    for shard_path in ([path] if os.path.exists(path) else []) + shard_paths:
+        with pd.HDFStore(shard_path, mode='r') as store:
+            if '/' + key.lstrip('/') in store.keys():
+                objects.append(store[key])
+    return objects
+
+
+def save_model_safely(snapshot, path):
+    """
+    Saves the model of a ModelSnapshot, without optimizer state. The model is rebuilt in a graph and session
+    of its own, which are local to the writer thread, so that the graph training goes on in is never touched
+    """
+    import tensorflow as tf
+    from keras.models import model_from_json
+
+    temp_path = path + '.tmp'
+    graph = tf.Graph()
+    with graph.as_default(), tf.Session(graph=graph) as session, session.as_default():
+        model = model_from_json(snapshot.architecture)
+        model.set_weights(snapshot.weights)
+        model.save(temp_path)
+    os.replace(temp_path, path)
+
+
+def save_pickle_safely(obj, path):
+    temp_path = path + '.tmp'
+    with open(temp_path, 'wb') as f:
+        pickle.dump(obj, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(temp_path, path)
+
+
+class AsyncWriter:
+    """
+    Runs all submitted writes in order in a background thread. Once max_pending writes are waiting,
+    submitting blocks until the writer catches up. Leaving the with-block waits for all writes.
+    After a write failed the remaining ones are skipped, later writes may depend on it.
+    """
+    def __init__(self, max_pending=writer_queue_size):
+        self.tasks = queue.Queue(maxsize=max_pending)
+        self.error = None
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def submit(self, function):
+        self.raise_error()
+        self.tasks.put(function)
+
+    def run(self):
+        while True:
+            function = self.tasks.get()
+            try:
+                if function is stop_writing:
+                    return
+                if self.error is None:
+                    function()
+            except Exception as error:
+                traceback.print_exc()
+                self.error = error
+            finally:
+                self.tasks.task_done()
+
+    def raise_error(self):
+        if self.error is not None:
+            raise RuntimeError('writing results failed') from self.error
+
+    def flush(self):
+        self.tasks.join()
+        self.raise_error()
+
+    def close(self):
+        self.tasks.put(stop_writing)
+        self.thread.join()
+        self.raise_error()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            # The pending writes are still completed, but do not hide the original error
+            self.tasks.put(stop_writing)
+            self.thread.join()
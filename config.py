@@ -25,6 +25,15 @@ end_year = 2016
 annualization = 252
 stock_count_to_pick = 6
 do_redownload_all_data = False
+dataset_backend = 'hdf'  # 'hdf' loads options_for_ann.h5 at once, 'parquet' reads stock/half-year partitions on demand
+options_csv_chunksize = 10**6  # rows per chunk when ingesting raw option files, None reads each file in one piece
+# Worker processes handling the yearly option files in parallel. Each worker holds one chunk of
+# options_csv_chunksize rows at a time and store_options buffers every year in a temporary HDF file
+# of its own, so memory grows with the number of workers, not with the size of the files
+preprocessing_workers = 1
+
+data_package_cache_mb = 1024  # memory budget for DataPackages reused across settings, 0 disables the cache
+prefetch_data_packages = True  # prepare the next model's DataPackage in a background thread during training
 
 overlapping_windows = True
 limit_windows = 'final-testing'  # one of ['single', 'hyper-param-search', 'final-testing', 'no', 'mock-testing']
@@ -85,6 +94,11 @@ multi_target = False
 useEarlyStopping = False
 
 identical_reruns = 1
+ensemble_identical_reruns = False  # train the identical reruns of a window as one ensemble, not used by scheduler.py
+reuse_compiled_models = False  # build and compile every architecture once, reinitializing it for every window
+training_workers = 1  # models trained at the same time in forked processes, each with its own DataPackage cache
+tf_intra_op_threads = 1  # threads of each TF session when training_workers > 1, 0 lets TensorFlow decide
+tf_inter_op_threads = 1
 
 activations = ['relu']
 number_of_nodes = [250]
@@ -146,9 +160,10 @@ else:
 paths = {
     'results-excel': os.path.join(localpath, 'results_excel.xlsx'),
     'results-excel-BS': os.path.join(localpath, 'results_excel-BS.xlsx'),
+    'results-db': os.path.join(localpath, 'results.sqlite'),
     'data_for_latex': os.path.join(rootpath, "data_for_latex.h5"),
     'options_for_ann': os.path.join(rootpath, "options_for_ann.h5"),
-    'weights': os.path.join(rootpath, "weights.h5"),
+    'options_for_ann_parquet': os.path.join(rootpath, "options_for_ann"),
     'neural_net_output': os.path.join(rootpath, "ANN-output.h5"),
     'model_overfit': os.path.join(rootpath, "overfit_model.h5"),
     'model_mape': os.path.join(rootpath, "mape_model.h5"),
@@ -175,8 +190,13 @@ paths = {
 # ----------------------------------
 # Output for Latex
 # ----------------------------------
+results_backend = 'excel'  # 'excel' rewrites the workbooks, 'sqlite' appends every finished model to results.sqlite
+resume_sweep = False  # continue the last run, skipping jobs already stored in results.sqlite (requires 'sqlite')
 saveResultsForLatex = True
 collect_gradients_data = True
+gradient_batch_size = 10000  # rows per evaluation of the input gradients (deltas, SSD, gradients data)
+writer_queue_size = 8  # results waiting for the background writer before training has to wait
+loaded_models_capacity = 4  # saved models a model_registry.ModelLoader keeps in memory
 
 # ----------------------------------
 # Disabling certain Warnings
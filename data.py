@@ -8,13 +8,29 @@ from config import (
     overlapping_windows,
     limit_windows,
     use_big_time_windows,
-    stock_count_to_pick
+    stock_count_to_pick,
+    dataset_backend
 )
 
-with pd.HDFStore(paths['options_for_ann']) as store:
-    data = store['data']
-    synth = store['synthetic']
-    availability_summary = store['availability_summary']
+if dataset_backend == 'parquet':
+    from dataset_store import read_dataset_frame
+    data = None  # the partitions are read on demand by actions.get_data_window
+    synth = read_dataset_frame('synthetic')
+    availability_summary = read_dataset_frame('availability_summary')
+else:
+    with pd.HDFStore(paths['options_for_ann']) as store:
+        data = store['data']
+        synth = store['synthetic']
+        availability_summary = store['availability_summary']
+
+
+def get_full_dataset(columns=None):
+    if data is None:
+        from dataset_store import read_dataset
+        return read_dataset(columns)
+    if columns is None:
+        return data
+    return data.loc[:, columns]
 
 
 selected_stocks = list(availability_summary.index)[0:stock_count_to_pick]
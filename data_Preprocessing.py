@@ -3,6 +3,9 @@ import numpy as np
 import datetime
 import calendar
 import gc
+import os
+from functools import partial
+from time import time
 
 import itertools
 
@@ -18,8 +21,13 @@ from config import (
     annualization,
     onCluster,
     optional_features,
-    option_type
+    option_type,
+    options_csv_chunksize,
+    preprocessing_workers,
+    dataset_backend
 )
+from dataset_store import write_partitioned_dataset
+from scheduler import get_fork_pool
 
 if not onCluster:
     from matplotlib import pyplot as plt
@@ -100,47 +108,101 @@ def fetch_and_store_sp500(db):
     return prc_merge, crsp_id
 
 
-def store_options(option_type='call'):
-    with pd.HDFStore(paths['prices_raw']) as store:
-        CRSP_const = store['CRSP_const']
+options_csv_columns = ['id', 'date', 'days', 'best_bid', 'best_offer', 'impl_volatility', 'delta', 'strike_price']
+options_csv_dtypes = {
+    'id': np.int64,
+    'date': str,
+    'days': np.float64,
+    'best_bid': np.float64,
+    'best_offer': np.float64,
+    'impl_volatility': np.float64,
+    'delta': np.float64,
+    'strike_price': np.float64
+}
+
+
+def prepare_options_chunk(data, option_type='call'):
+    # Quotes without a bid have no meaningful mid price
+    listO = data.loc[data.best_bid > 0, options_csv_columns]
+
+    option_price = (listO.best_bid + listO.best_offer) / 2
+    listO = pd.concat([listO, option_price], axis=1).rename(columns={0: 'option_price'})
+    listO.drop(['best_bid', 'best_offer'], axis=1, inplace=True)
+
+    listO['date'] = pd.to_datetime(listO['date'], format='%d%b%Y')
+    if option_type == 'call':
+        idx3 = listO['delta'] > 0
+    elif option_type == 'put':
+        idx3 = listO['delta'] < 0
+    else:
+        raise ValueError("option_type must be either 'call' or 'put'")
+    listO = listO.loc[idx3, :]
+    listO['strike_price'] = listO['strike_price'] / 1000
+    return listO
 
-    # Create constituents data frame
-    open(paths['all_options_h5'], 'w').close()  # delete previous HDF
-    CRSP_const = CRSP_const[CRSP_const['ending'] > '1996-01-01']
-
-    st_y = pd.to_datetime(CRSP_const['start'])
-    en_y = pd.to_datetime(CRSP_const['ending'])
-
-    for file in paths['options']:
-        print(file)
-        with open(file, 'r') as o:
-            data = pd.read_csv(o)
-
-        year_index = file.find('rawopt_')
-        cur_y = file[year_index + 7:year_index + 7 + 4]
-        idx1 = st_y <= cur_y
-        idx2 = en_y >= cur_y
-        idx3 = data.best_bid > 0
-        idx = idx1 & idx2 & idx3
-        const = CRSP_const.loc[idx, :].reset_index(drop=True)
-        listO = data[['id', 'date', 'days', 'best_bid', 'best_offer', 'impl_volatility', 'delta', 'strike_price']]
-
-        option_price = (listO.best_bid + listO.best_offer) / 2
-        listO = pd.concat([listO, option_price], axis=1).rename(columns={0: 'option_price'})
-        listO.drop(['best_bid', 'best_offer'], axis=1, inplace=True)
-
-        listO['date'] = pd.to_datetime(listO['date'], format='%d%b%Y')
-        if option_type == 'call':
-            idx3 = listO['delta'] > 0
-        elif option_type == 'put':
-            idx3 = listO['delta'] < 0
+
+def get_options_file_year(file):
+    year_index = file.find('rawopt_')
+    return file[year_index + 7:year_index + 7 + 4]
+
+
+def read_options_file(file, option_type='call', chunksize=options_csv_chunksize, verbose=True):
+    # With a chunksize only one chunk of the raw file is held in memory at a time
+    with open(file, 'r') as o:
+        if chunksize is None:
+            chunks = [pd.read_csv(o)]
         else:
-            raise ValueError("option_type must be either 'call' or 'put'")
-        listO = listO.loc[idx3, :]
-        listO['strike_price'] = listO['strike_price'] / 1000
-        print(listO.shape)
-        with pd.HDFStore(paths['all_options_h5']) as store:
-            store.append('options' + cur_y, listO, index=False, data_columns=True)
+            chunks = pd.read_csv(o, usecols=options_csv_columns, dtype=options_csv_dtypes, chunksize=chunksize)
+
+        rows_read = rows_stored = 0
+        ts = time()
+        for data in chunks:
+            listO = prepare_options_chunk(data, option_type)
+            rows_read += len(data)
+            rows_stored += len(listO)
+            del data
+            if verbose:
+                print('\r{:,} rows read, {:,} stored ({:,.0f} rows/s)'.format(
+                    rows_read, rows_stored, rows_read / max(time() - ts, 1e-9)), end='', flush=True)
+            yield listO
+    print('\r{}: {:,} rows read, {:,} stored in {:.0f}s'.format(file, rows_read, rows_stored, time() - ts))
+
+
+def store_options_file(file, option_type='call', chunksize=options_csv_chunksize):
+    # A worker streams its year into a temporary store of its own, so it never holds more than one chunk
+    cur_y = get_options_file_year(file)
+    temp_path = '{}.{}.tmp'.format(paths['all_options_h5'], cur_y)
+    with pd.HDFStore(temp_path, mode='w') as store:
+        for listO in read_options_file(file, option_type, chunksize, verbose=False):
+            store.append('options', listO, index=False, data_columns=True)
+    return cur_y, temp_path
+
+
+def store_options(option_type='call', chunksize=options_csv_chunksize, processes=preprocessing_workers):
+    open(paths['all_options_h5'], 'w').close()  # delete previous HDF
+
+    pool = get_fork_pool(min(processes, len(paths['options'])))
+    if pool is None:
+        for file in paths['options']:
+            print(file)
+            cur_y = get_options_file_year(file)
+            with pd.HDFStore(paths['all_options_h5']) as store:
+                for listO in read_options_file(file, option_type, chunksize):
+                    store.append('options' + cur_y, listO, index=False, data_columns=True)
+    else:
+        # Each year is filtered in its own worker, only the main process writes to the store,
+        # copying the temporary stores of the workers chunk by chunk as they finish
+        with pool:
+            worker = partial(store_options_file, option_type=option_type, chunksize=chunksize)
+            for cur_y, temp_path in pool.imap_unordered(worker, paths['options']):
+                with pd.HDFStore(temp_path, mode='r') as temp_store, pd.HDFStore(paths['all_options_h5']) as store:
+                    if '/options' in temp_store.keys():
+                        # Without a chunksize select returns the whole year instead of an iterator of chunks
+                        chunks = temp_store.select('options', chunksize=chunksize) if chunksize else \
+                            [temp_store.select('options')]
+                        for listO in chunks:
+                            store.append('options' + cur_y, listO, index=False, data_columns=True)
+                os.remove(temp_path)
 
 
 def determine_available_wrds_data(db=None):
@@ -317,16 +379,36 @@ print(', names')
 with pd.HDFStore(paths['names']) as store:
     names = store['names']
 
-df = pd.DataFrame()
-options_data_year = None
-for year in range(start_year, end_year):  # range(1996, 2016)
-    print('Loading options for year {}'.format(year))
-
-    with pd.HDFStore(paths['all_options_h5']) as store:
-        options_data_year = store['options' + str(year)]
+def load_options_year(year, start=None, stop=None):
+    with pd.HDFStore(paths['all_options_h5'], mode='r') as store:
+        options_data_year = store.select('options' + str(year), start=start, stop=stop)
     options_data_year.rename(index=str, columns={"id": "permno"}, inplace = True)
     options_data_year.set_index(['date','permno'],inplace=True)
-    df = df.append(options_data_year)
+    return options_data_year
+
+
+def get_options_year_slices(years, chunksize=options_csv_chunksize):
+    # Workers load row ranges instead of whole years, so each of them only holds and pickles one chunk
+    with pd.HDFStore(paths['all_options_h5'], mode='r') as store:
+        for year in years:
+            nrows = store.get_storer('options' + str(year)).nrows
+            step = chunksize or max(nrows, 1)
+            for start in range(0, nrows, step):
+                yield year, start, start + step
+
+
+years = range(start_year, end_year)  # range(1996, 2016)
+pool = get_fork_pool(min(preprocessing_workers, len(years)))
+if pool is None:
+    options_data_years = []
+    for year in years:
+        print('Loading options for year {}'.format(year))
+        options_data_years.append(load_options_year(year))
+else:
+    with pool:
+        options_data_years = pool.starmap(load_options_year, get_options_year_slices(years))
+df = pd.concat(options_data_years)
+del(options_data_years)
 
 print('Calculating returns and volas')
 returns = prices.pct_change()
@@ -379,7 +461,6 @@ merged['v5'] = ser_v5
 
 print('Cleaning memory')
 del(df)
-del(options_data_year)
 del(prices_raw)
 del(ser_v5)
 del(ser_v20)
@@ -554,14 +635,29 @@ with pd.HDFStore(paths['prices_raw']) as store:
 prices_raw['permno'] = prices_raw['permno'].astype(np.int64)
 prices_raw['date'] = prices_raw['date'].astype('datetime64[ns]')
 prices_raw.set_index(['date','permno'],inplace=True)
-dateindex = prices_raw.index.get_level_values(0)
-stockindex = prices_raw.index.get_level_values(1)
-def get_prc_atExpiration(point):
-    idx = stockindex == point.name[1]
-    idx &= dateindex < point.expiration_date
-    return prices_raw.loc[idx, 'prc'].sort_index(axis=0, level=1).iloc[-1]
 
-downsampled_df['prc_atExpiration'] = downsampled_df.apply(get_prc_atExpiration, axis=1)
+def get_prc_atExpiration(options, prices_raw):
+    # As-of join: for every option the last recorded price of its stock strictly before the expiration date
+    quotes = pd.DataFrame({
+        'permno': options.index.get_level_values(1).astype(np.int64),
+        'expiration_date': options['expiration_date'].values.astype('datetime64[ns]'),
+        'position': np.arange(len(options))
+    })
+    quotes.sort_values('expiration_date', kind='mergesort', inplace=True)
+
+    price_history = pd.DataFrame({
+        'permno': prices_raw.index.get_level_values(1).astype(np.int64),
+        'date': prices_raw.index.get_level_values(0).values.astype('datetime64[ns]'),
+        'prc': prices_raw['prc'].values
+    })
+    price_history.sort_values('date', kind='mergesort', inplace=True)
+
+    matched = pd.merge_asof(quotes, price_history, left_on='expiration_date', right_on='date', by='permno',
+                            direction='backward', allow_exact_matches=False)
+    matched.sort_values('position', inplace=True)
+    return matched['prc'].values
+
+downsampled_df['prc_atExpiration'] = get_prc_atExpiration(downsampled_df, prices_raw)
 
 downsampled_df.comnam = downsampled_df.comnam.astype('str')
 downsampled_df.ticker = downsampled_df.ticker.astype('str')
@@ -737,9 +833,12 @@ def generate_synthetic_data(option_type='call'):
 synth_df = generate_synthetic_data()
 
 print('Storing result on disc')
-with pd.HDFStore(paths['options_for_ann']) as store:
-    store['data'] = data
-    store['synthetic'] = synth_df
-    store['availability_summary'] = availability_summary
+if dataset_backend == 'parquet':
+    write_partitioned_dataset(data, synth_df, availability_summary)
+else:
+    with pd.HDFStore(paths['options_for_ann']) as store:
+        store['data'] = data
+        store['synthetic'] = synth_df
+        store['availability_summary'] = availability_summary
 
 print('Done')
@@ -0,0 +1,93 @@
+import os
+import shutil
+import numpy as np
+import pandas as pd
+
+from config import paths
+
+# The preprocessed dataset is stored as one Parquet file per stock and half-year:
+#   <root>/data/permno=<permno>/<year>H<1|2>.parquet
+# next to <root>/synthetic.parquet and <root>/availability_summary.parquet
+
+
+def get_half_year(date):
+    return '{}H{}'.format(date.year, 1 if date.month <= 6 else 2)
+
+
+def get_half_year_bounds(half_year):
+    year, half = half_year.split('H')
+    start = pd.Timestamp('{}-{}-01'.format(year, '01' if half == '1' else '07'))
+    end = start + pd.DateOffset(months=6)
+    return start, end
+
+
+def write_partitioned_dataset(data, synth, availability_summary, root=paths['options_for_ann_parquet']):
+    data_dir = os.path.join(root, 'data')
+    if os.path.exists(data_dir):
+        shutil.rmtree(data_dir)
+
+    dates = data.index.get_level_values(0)
+    stocks = data.index.get_level_values(1).astype(np.int64)
+    half_years = [get_half_year(date) for date in dates]
+    for (stock, half_year), partition in data.groupby([stocks, half_years]):
+        partition_dir = os.path.join(data_dir, 'permno={}'.format(stock))
+        if not os.path.exists(partition_dir):
+            os.makedirs(partition_dir)
+        partition.to_parquet(os.path.join(partition_dir, half_year + '.parquet'))
+
+    synth.to_parquet(os.path.join(root, 'synthetic.parquet'))
+    availability_summary.to_parquet(os.path.join(root, 'availability_summary.parquet'))
+
+
+def read_dataset_frame(name, root=paths['options_for_ann_parquet']):
+    return pd.read_parquet(os.path.join(root, name + '.parquet'))
+
+
+def get_partition_files(stock=None, start_date=None, end_date=None, root=paths['options_for_ann_parquet']):
+    data_dir = os.path.join(root, 'data')
+    if stock is None:
+        stock_dirs = sorted(os.listdir(data_dir))
+    else:
+        stock_dirs = ['permno={}'.format(int(stock))]
+
+    files = []
+    for stock_dir in stock_dirs:
+        partition_dir = os.path.join(data_dir, stock_dir)
+        if not os.path.isdir(partition_dir):
+            continue
+        half_years = sorted(filename[:-len('.parquet')] for filename in os.listdir(partition_dir))
+        for half_year in half_years:
+            half_year_start, half_year_end = get_half_year_bounds(half_year)
+            if start_date is not None and half_year_end <= pd.Timestamp(start_date):
+                continue
+            if end_date is not None and half_year_start >= pd.Timestamp(end_date):
+                continue
+            files.append(os.path.join(partition_dir, half_year + '.parquet'))
+    return files
+
+
+def read_dataset_window(stock, start_date, end_date, columns=None, root=paths['options_for_ann_parquet']):
+    """
+    Reads the rows of a single stock with start_date <= date < end_date,
+    touching only the overlapping half-year partitions and the requested columns
+    """
+    files = get_partition_files(stock, start_date, end_date, root)
+    if not files:
+        raise KeyError('No data stored for stock {} between {} and {}'.format(stock, start_date, end_date))
+    window = pd.concat([pd.read_parquet(file, columns=columns) for file in files])
+
+    dates = window.index.get_level_values(0)
+    idx = (dates >= start_date) & (dates < end_date)
+    return window.loc[idx]
+
+
+def read_dataset(columns=None, root=paths['options_for_ann_parquet']):
+    frames = [pd.read_parquet(file, columns=columns) for file in get_partition_files(root=root)]
+    return pd.concat(frames).sort_index()
+
+
+if __name__ == '__main__':
+    # Converts an existing options_for_ann.h5 into the partitioned layout
+    with pd.HDFStore(paths['options_for_ann']) as store:
+        write_partitioned_dataset(store['data'], store['synthetic'], store['availability_summary'])
+    print('Done')
@@ -3,7 +3,12 @@ import tensorflow as tf
 from keras import backend as K
 from datetime import datetime
 import itertools
+import hashlib
+import socket
 import os
+from collections import namedtuple, Counter, defaultdict, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 
 from config import (
     paths,
@@ -11,6 +16,7 @@ from config import (
     settings_combi_count,
     active_feature_combinations,
     identical_reruns,
+    ensemble_identical_reruns,
     settings_list,
     full_feature_combination_list,
     batch_normalization,
@@ -25,24 +31,55 @@ from config import (
     onCluster,
     collect_gradients_data,
     useEarlyStopping,
-    loss_func
+    loss_func,
+    results_backend,
+    resume_sweep,
+    training_workers,
+    tf_intra_op_threads,
+    tf_inter_op_threads,
+    prefetch_data_packages,
+    reuse_compiled_models
 )
 from models import (
     full_model,
     multitask_model,
+    ensemble_model,
+    reinitialize_model,
 )
 from actions import (
-    get_data_package,
+    DataPackageCache,
+    build_window_index,
     run_and_store_ann,
+    run_ensemble,
     run,
     run_black_scholes,
-    get_gradients,
+    get_gradients_data,
     get_ssd,
 )
 from data import (
     windows_list,
     window_combi_count,
 )
+from async_writer import (
+    AsyncWriter,
+    update_hdf_safely,
+    write_hdf_shard,
+    ModelSnapshot,
+    save_model_safely,
+    save_pickle_safely,
+)
+from numpy_inference import get_scalers_path
+from scheduler import get_fork_pool
+from results_store import (
+    start_run,
+    append_results,
+    get_last_run_id,
+    get_completed_job_keys,
+)
+from model_registry import (
+    register_model,
+    get_model_record,
+)
 if not onCluster:
     from plotting_actions import (
         get_and_plot,
@@ -50,384 +87,671 @@ if not onCluster:
     )
 
 
-def perform_experiment():
-
-    # Initializing some variables to suppress linter warnings
-    data_package = shared_layers = individual_layers = MSHE = MSHE_oos = MAPHE = MAPHE_oos = None
-    N_train = N_val = X_train = X_val = data = scaler_X = model_name = None
+def get_job_key(*job):
+    """
+    Deterministic identifier of a training job, e.g. (settings, stock, date_tuple, rerun_id),
+    which also covers the global training configuration so that changed configs never match
+    """
+    description = repr(job + (epochs, separate_initial_epochs, lr, loss_func, multi_target, batch_normalization))
+    return hashlib.sha1(description.encode()).hexdigest()
+
+
+watches = ['model_name', 'time', 'optimizer', 'lr', 'epochs', 'features', 'activation', 'layers', 'nodes',
+           'batch_normalization', 'loss', 'loss_oos', 'used_synth', 'normalize', 'dropout', 'batch_size',
+           'failed', 'loss_mean', 'loss_std', 'val_loss_mean', 'val_loss_std', 'stock', 'dt_start', 'dt_middle',
+           'dt_end', 'duration', 'N_train', 'N_val', 'regularizer', 'useEarlyStopping', 'loss_func', 'MSHE',
+           'MSHE_oos', 'MAPHE', 'MAPHE_oos']
+
+TrainingJob = namedtuple('TrainingJob', 'i j settings window job_key runID')
+TrainingResult = namedtuple('TrainingResult', 'job row model_name model_record model_snapshot scalers sample_data '
+                                               'SSD_train SSD_val outputs gradients_df cache_counters')
+
+data_package_cache = None
+compiled_models = {}
+
+
+def get_process_id():
+    return '{}:{}'.format(socket.gethostname(), os.getpid())
+
+
+def get_cache_report(cache_counters):
+    """
+    Sums the DataPackage cache counters of this process and of the workers, whose caches are their own
+    """
+    counters = dict(cache_counters)
+    if data_package_cache is not None:
+        counters[get_process_id()] = data_package_cache.get_counters()
+    hits, misses, evictions = (sum(values) for values in zip(*counters.values())) if counters else (0, 0, 0)
+    msg = 'DataPackage cache in {} processes: {} hits, {} misses, {} evictions'.format(
+        len(counters), hits, misses, evictions)
+    if data_package_cache is not None:
+        msg += ', this process holds ' + data_package_cache.report()
+    return msg
+
+
+def set_training_session():
+    if training_workers > 1:
+        # Several training processes share the node, each TF session is restricted to a few threads
+        session_config = tf.ConfigProto(intra_op_parallelism_threads=tf_intra_op_threads,
+                                        inter_op_parallelism_threads=tf_inter_op_threads)
+        K.set_session(tf.Session(config=session_config))
+
+
+def get_training_jobs(runID, completed_job_keys):
+    i = 0
+    for settings in itertools.product(*settings_list):  # equivalent to a bunch of nested for-loops
+        i += 1
+        j = 0
+        for window in itertools.product(*windows_list):
+            j += 1
+            stock, date_tuple, rerun_id = window
+            job_key = get_job_key(settings, int(stock), date_tuple, rerun_id)
+            if job_key in completed_job_keys:
+                print('{}.{} already done'.format(i, j))
+                continue
+            yield TrainingJob(i, j, settings, window, job_key, runID)
+
+
+def build_model(architecture):
+    if multi_target:
+        return multitask_model(**architecture)
+    return full_model(**architecture)
+
+
+def get_model(architecture):
+    """
+    Builds and compiles the model, or with reuse_compiled_models, reinitializes the model built
+    for the same architecture before, which saves the graph construction and compilation
+    """
+    if not reuse_compiled_models:
+        return build_model(architecture)
+    key = tuple(sorted(architecture.items()))
+    if key in compiled_models:
+        reinitialize_model(compiled_models[key])
+    else:
+        compiled_models[key] = build_model(architecture)
+    return compiled_models[key]
+
+
+def get_job_data_package(job):
+    (act, n, layers, optimizer, include_synthetic_data, dropout_rate,
+     normalization, batch_size, regularizer, c) = job.settings
+    stock, (dt_start, dt_middle, dt_end), rerun_id = job.window
+    return data_package_cache.get_data_package(
+        model=None,
+        columns=full_feature_combination_list[c],
+        output_columns=['scaled_option_price', 'perfect_hedge_1'] if multi_target else ['scaled_option_price'],
+        include_synth=include_synthetic_data,
+        normalize=normalization,
+        stock=stock,
+        start_date=dt_start,
+        end_train_start_val_date=dt_middle,
+        end_val_date=dt_end
+    )
 
-    try:
-        with pd.ExcelFile(paths['results-excel']) as reader:
-            runID = reader.parse("RunData")['runID'].max() + 1
-    except FileNotFoundError:
-        runID = 1
 
+def train_jobs_with_prefetch(job_groups):
+    """
+    Trains the groups of jobs one after the other, while a background thread prepares the DataPackage of the
+    next group. The prefetched package is handed to train_job_group directly, it does not depend on the
+    DataPackage cache
+    """
+    with ThreadPoolExecutor(max_workers=1) as prefetcher:
+        prefetched = prefetcher.submit(get_job_data_package, job_groups[0][0]) if job_groups else None
+        for jobs, next_jobs in zip(job_groups, job_groups[1:] + [None]):
+            data_package = prefetched.result()
+            if next_jobs is not None:
+                prefetched = prefetcher.submit(get_job_data_package, next_jobs[0])
+            yield train_job_group(jobs, data_package)
+
+
+def get_job_groups(jobs):
+    """
+    Groups the jobs that are trained together: with ensemble_identical_reruns the reruns of the same settings and
+    window, which share their data, otherwise every job on its own
+    """
+    if not ensemble_identical_reruns:
+        return [[job] for job in jobs]
+    if multi_target or useEarlyStopping:
+        raise ValueError('ensemble_identical_reruns supports neither multi_target nor useEarlyStopping')
+    groups = OrderedDict()
+    for job in jobs:
+        stock, date_tuple, rerun_id = job.window
+        groups.setdefault((job.settings, stock, date_tuple), []).append(job)
+    return list(groups.values())
+
+
+def train_job_group(jobs, data_package=None):
+    if len(jobs) == 1:
+        return [train_job(jobs[0], data_package)]
+    return train_ensemble_jobs(jobs, data_package)
+
+
+def train_ensemble_jobs(jobs, data_package=None):
+    """
+    Trains the models of jobs that only differ in their rerun_id as the members of one ensemble_model, which
+    need no padding as they share their data, and evaluates every member with train_job
+    """
+    if not (reuse_compiled_models and compiled_models):
+        set_training_session()
+    _, architecture = get_model_name_and_architecture(jobs[0].settings)
+    batch_size = jobs[0].settings[7]
+    if data_package is None:
+        data_package = get_job_data_package(jobs[0])
+    data_packages = [data_package] * len(jobs)
+
+    ensemble = ensemble_model(len(jobs), **architecture)
+    if lr is not None:
+        K.set_value(ensemble.optimizer.lr, lr)
+    # The members after the initial epochs and after all epochs, as train_job trains a model in two phases
+    phases = []
+    for nb_epochs in (separate_initial_epochs, epochs - separate_initial_epochs):
+        members, histories = run_ensemble(ensemble, data_packages, architecture, nb_epochs=nb_epochs,
+                                          batch_size=batch_size)
+        phases.append(zip(members, histories))
+    results = [train_job(job, data_package, ensemble_phases=(initial, final))
+               for job, initial, final in zip(jobs, *phases)]
+
+    if not reuse_compiled_models:
+        K.clear_session()
+        tf.reset_default_graph()
+    return results
+
+
+def get_model_name_and_architecture(settings):
+    (act, n, layers, optimizer, include_synthetic_data, dropout_rate,
+     normalization, batch_size, regularizer, c) = settings
+    used_features = full_feature_combination_list[c]
+    shared_layers = individual_layers = None
+    if type(layers) is tuple:
+        shared_layers, individual_layers = layers
+        layers = shared_layers + individual_layers
+
+    pattern = 'c{}_act{}_lf{}_l{}_n{}_o{}_bn{}_do{}_s{}_no{}_bs{}_r{}'
+    model_name = pattern.format(c, act, loss_func, layers, n, optimizer, int(batch_normalization),
+                                int(dropout_rate*10), int(include_synthetic_data),
+                                normalization, batch_size, regularizer)
+
+    if multi_target:
+        model_name = 'multit_'+model_name
+
+        architecture = dict(input_dim=len(used_features), shared_layers=shared_layers,
+                            individual_layers=individual_layers, nodes_per_layer=n,
+                            activation=act, use_batch_normalization=batch_normalization,
+                            optimizer=optimizer)
+    else:
+        model_name = 'full_'+model_name
+
+        architecture = dict(input_dim=len(used_features), num_layers=layers, nodes_per_layer=n,
+                            loss=loss_func, activation=act, optimizer=optimizer,
+                            use_batch_normalization=batch_normalization,
+                            dropout_rate=dropout_rate, regularizer=regularizer)
+    return model_name, architecture
+
+
+def train_job(job, data_package=None, ensemble_phases=None):
+    """
+    Trains and evaluates the model of a single (settings, window) job, either in the main process or in a worker.
+    Nothing is written to the shared result files here, that is left to store_training_result.
+    With ensemble_phases the model was trained as a member of an ensemble, see train_ensemble_jobs
+    """
+    i, j, settings, window, job_key, runID = job
+    (act, n, layers, optimizer, include_synthetic_data, dropout_rate,
+     normalization, batch_size, regularizer, c) = settings
+    used_features = full_feature_combination_list[c]
+    if type(layers) is tuple:
+        layers = sum(layers)
+    stock, date_tuple, rerun_id = window
+    dt_start, dt_middle, dt_end = date_tuple
+
+    # A new session would lose the compiled models, so when they are reused it is only set up once,
+    # the members of an ensemble live in the session of the ensemble
+    if ensemble_phases is None and not (reuse_compiled_models and compiled_models):
+        set_training_session()
+
+    # We initialize these variables to None because they will be part of the result row
+    loss_oos = last_losses_mean = last_losses_std = last_val_losses_mean = last_val_losses_std = None
+    MSHE = MSHE_oos = MAPHE = MAPHE_oos = SSD_train = SSD_val = gradients_df = sample_data = None
+    outputs = []
+
+    model_name, architecture = get_model_name_and_architecture(settings)
+    if ensemble_phases is None:
+        model = initial_model = get_model(architecture)
+        initial_history = history = None
+        if lr is not None:
+            K.set_value(model.optimizer.lr, lr)
+    else:
+        # The member after the initial epochs and after all epochs, with the history of each phase
+        (initial_model, initial_history), (model, history) = ensemble_phases
+    model.name = initial_model.name = model_name
+
+    # Unless it was prefetched, reruns and settings that only differ in the model are served from the cache
+    if data_package is None:
+        data_package = get_job_data_package(job)
+    N_train = len(data_package[0][0])
+    N_val = len(data_package[0][2])
+
+    actual_epochs = epochs
+    starting_time = datetime.now()
+    starting_time_str = '{:%Y-%m-%d_%H-%M}'.format(starting_time)
+
+    annResult = run_and_store_ann(model=initial_model, in_sample=True, model_name='i_' + model_name + '_inSample',
+                                  nb_epochs=separate_initial_epochs, reset='yes', columns=used_features,
+                                  include_synth=include_synthetic_data, normalize=normalization,
+                                  batch_size=batch_size, data_package=data_package,
+                                  starting_time_str=starting_time_str, store_output=False,
+                                  trained_history=initial_history)
+    outputs.append(('i_' + model_name + '_inSample', annResult.output))
+    initial_hist = annResult.history
+    initial_loss = annResult.last_loss
+
+    data = data_package.data
+    scaler_X = data_package.scaler_X
+    X_train = data[0]
+    X_val = data[2]
+
+    # During early experimentation it was useful to quickly abort models that failed to converge
+    failed = initial_loss > required_precision
+    if failed:
+        # Training stops after the initial epochs, which matters for the members of an ensemble
+        model = initial_model
+        loss = initial_loss
+        if useEarlyStopping:
+            actual_epochs = len(initial_hist.history['loss'])
+
+    else:
+        annResult = run_and_store_ann(model=model, in_sample=True, model_name=model_name + '_inSample',
+                                      nb_epochs=epochs - separate_initial_epochs, reset='continue',
+                                      columns=used_features, get_deltas=True,
+                                      include_synth=include_synthetic_data, normalize=normalization,
+                                      batch_size=batch_size, data_package=data_package,
+                                      starting_time_str=starting_time_str, store_output=False,
+                                      trained_history=history)
+        outputs.append((model_name + '_inSample', annResult.output))
+        hist, loss, loss_tuple, MSHE, MAPHE, _ = annResult
+
+        annResult = run_and_store_ann(model=model, in_sample=False, model_name=model_name + '_outSample',
+                                      reset='reuse', columns=used_features, get_deltas=True,
+                                      normalize=normalization, batch_size=batch_size,
+                                      data_package=data_package, starting_time_str=starting_time_str,
+                                      store_output=False)
+        outputs.append((model_name + '_outSample', annResult.output))
+        loss_oos = annResult.last_loss
+        MSHE_oos = annResult.MSHE
+        MAPHE_oos = annResult.MAPHE
+
+        if useEarlyStopping:
+            actual_epochs = len(hist.history['loss'])+len(initial_hist.history['loss'])
+
+        (last_losses_mean, last_losses_std, last_val_losses_mean, last_val_losses_std) = loss_tuple
+
+        SSD_train = get_ssd(model, X_train)
+        SSD_val = get_ssd(model, X_val)
+
+    model_end_time = datetime.now()
+
+    feature_string = '_'.join(used_features)
+    pos_fff = feature_string.find("_ff_ind")
+    # reducing the long string of fama & french factors down
+    if pos_fff > -1:
+        feature_string = feature_string[0:pos_fff] + "_fff"
+
+    row = {
+        'model_name': model_name,
+        'time': datetime.now(),
+        'duration': model_end_time - starting_time,
+        'N_train': N_train,
+        'N_val': N_val,
+
+        'stock': stock,
+        'dt_start': dt_start,
+        'dt_middle': dt_middle,
+        'dt_end': dt_end,
+
+        'failed': int(failed),
+        'loss': loss,
+        'loss_oos': loss_oos,
+        'loss_mean': last_losses_mean,
+        'loss_std': last_losses_std,
+        'val_loss_mean': last_val_losses_mean,
+        'val_loss_std': last_val_losses_std,
+        'MSHE': MSHE,
+        'MSHE_oos': MSHE_oos,
+        'MAPHE': MAPHE,
+        'MAPHE_oos': MAPHE_oos,
+
+        'epochs': actual_epochs,
+        'optimizer': optimizer,
+        'lr': lr,
+        'features': feature_string,
+        'activation': act,
+        'layers': layers,
+        'nodes': n,
+        'batch_normalization': batch_normalization,
+        'loss_func': loss_func,
+
+        'used_synth': int(include_synthetic_data),
+        'normalize': normalization,
+        'dropout': dropout_rate,
+        'batch_size': batch_size,
+        'regularizer': regularizer,
+        'useEarlyStopping': int(useEarlyStopping),
+    }
+
+    # Jobs of the same settings may run at the same time, so the window is part of the filename
+    filename = '{}_{}_{}_{}_{}.h5'.format(model_name, starting_time_str, stock, dt_start, rerun_id)
+    model_path = os.path.abspath(os.path.join(paths['all_models'], filename))
+    # The model and its scalers are saved by the writer, without the scalers fitted on this window
+    # the saved model could not price new quotes
+    model_snapshot = ModelSnapshot(model.to_json(), model.get_weights())
+    scalers = dict(features=list(used_features), scaler_X=scaler_X, scaler_Y=data_package.scaler_Y)
+    scalers_path = get_scalers_path(model_path)
+    model_record = get_model_record(model_path, scalers_path, c, used_features, rerun_id)
+
+    if i == 1 and j == i:
+        # sample model to be particularly investigated
+
+        _, Y_prediction, _ = run(model,
+                                 data=data,
+                                 reset='reuse',
+                                 plot_prediction=False,
+                                 segment_plot=False,
+                                 verbose=0,
+                                 model_name=model_name,
+                                 in_sample=False,
+                                 batch_size=batch_size,
+                                 starting_time_str=starting_time_str)
+
+        sample_data = dict(X_train=X_train, X_test=X_val, Y_train=data[1], Y_test=data[3],
+                           Y_prediction=pd.Series(Y_prediction.flatten()))
+
+    featureCounts_to_record = [len(full_feature_combination_list[-1])]
+    is_All_or_None_Run = len(used_features) in featureCounts_to_record
+    if collect_gradients_data and is_All_or_None_Run:
+        sampling_dict = dict(train=X_train, test=X_val)
+        gradients_df = get_gradients_data(model, sampling_dict, scaler_X, model_name=model_name,
+                                          time=starting_time, stock=stock, dt_start=dt_start,
+                                          runID=runID)
+
+    if not reuse_compiled_models and ensemble_phases is None:
+        K.clear_session()
+        tf.reset_default_graph()
+
+    # The workers' caches are their own, their counters travel with the results
+    cache_counters = (get_process_id(), data_package_cache.get_counters())
+    return TrainingResult(job, row, model_name, model_record, model_snapshot, scalers, sample_data,
+                          SSD_train, SSD_val, outputs, gradients_df, cache_counters)
+
+
+def store_training_result(result, writer):
+    # Only the writer of the main process writes the results, HDF5 files must not be written by several
+    # processes or threads. Saving the models there also keeps Keras out of the training thread's way
+    writer.submit(partial(save_model_safely, result.model_snapshot, result.model_record['file_path']))
+    writer.submit(partial(save_pickle_safely, result.scalers, result.model_record['scalers_path']))
+    if result.sample_data is not None:
+        def store_sample_data(store):
+            for key, sample in result.sample_data.items():
+                store[key] = sample
+        writer.submit(partial(save_model_safely, result.model_snapshot, paths['sample_model']))
+        writer.submit(partial(update_hdf_safely, paths['sample_data'], [store_sample_data]))
+
+    # The outputs and gradients of a job are written to shards named by its job_key
+    def store_outputs(store):
+        for key, output in result.outputs:
+            store[key] = output
+    writer.submit(partial(write_hdf_shard, paths['neural_net_output'], result.job.job_key, [store_outputs]))
+
+    if limit_windows != 'mock-testing':
+        if result.gradients_df is not None:
+            def store_gradients(store):
+                store.append('gradients_data', result.gradients_df, index=False, data_columns=True)
+            writer.submit(partial(write_hdf_shard, paths['gradients_data'], result.job.job_key,
+                                  [store_gradients]))
+
+        if results_backend == 'sqlite':
+            # Every finished model is committed right away instead of at the end of the run. The writer runs
+            # in order, so the row marks the job as complete only once its outputs have been written
+            row = dict(result.row, runID=result.job.runID, job_key=result.job.job_key)
+            writer.submit(partial(append_results, [row], 'RunData'))
+
+        # The registry is independent of the results backend, it is what finds the saved models later on
+        record = dict(result.row, runID=result.job.runID, job_key=result.job.job_key, **result.model_record)
+        writer.submit(partial(register_model, record))
+
+
+def store_SSD_distribution(settings, model_name, SSD_distribution_train, SSD_distribution_val, runID, writer):
+    include_synthetic_data = settings[4]
+    used_features = full_feature_combination_list[settings[-1]]
+
+    if not onCluster and len(used_features) > 4:
+        boxplot_SSD_distribution(SSD_distribution_train, used_features, 'Training Data', model_name)
+        boxplot_SSD_distribution(SSD_distribution_val, used_features, 'Validation Data', model_name)
+
+    if saveResultsForLatex:
+        SSDD_df_train = pd.DataFrame(SSD_distribution_train, columns=used_features)
+        SSDD_df_val = pd.DataFrame(SSD_distribution_val, columns=used_features)
+        SSDD_df_train['sample'] = 'train'
+        SSDD_df_val['sample'] = 'test'
+        merged_results = pd.concat([SSDD_df_train, SSDD_df_val])
+        merged_results['runID'] = runID
+        merged_results['used_synth'] = include_synthetic_data
+
+        def store_SSDD(store):
+            if '/SSDD_df' in store.keys():
+                store['SSDD_df'] = pd.concat([merged_results, store['SSDD_df']])
+            else:
+                store['SSDD_df'] = merged_results
+        writer.submit(partial(update_hdf_safely, paths['data_for_latex'], [store_SSDD]))
+
+
+def get_run():
+    """
+    Returns the runID together with the job keys of that run which are already stored
+    """
+    completed_job_keys = BS_completed_job_keys = set()
+    if resume_sweep and results_backend != 'sqlite':
+        raise ValueError("resume_sweep requires results_backend = 'sqlite'")
+
+    if results_backend == 'sqlite':
+        runID = get_last_run_id() if resume_sweep else None
+        if runID is None:
+            runID = start_run()
+        else:
+            completed_job_keys = get_completed_job_keys(runID, 'RunData')
+            BS_completed_job_keys = get_completed_job_keys(runID, 'BSRunData')
+        if resume_sweep:
+            print('Resuming run {}, {} jobs already done'.format(
+                runID, len(completed_job_keys) + len(BS_completed_job_keys)))
+    else:
+        try:
+            with pd.ExcelFile(paths['results-excel']) as reader:
+                runID = reader.parse("RunData")['runID'].max() + 1
+        except FileNotFoundError:
+            runID = 1
+    return runID, completed_job_keys, BS_completed_job_keys
+
+
+def init_training_process():
+    global data_package_cache
     if not os.path.exists(paths['all_models']):
         os.makedirs(paths['all_models'])
+    data_package_cache = DataPackageCache()
+    # The dataset index is built before forking, so that all workers share it
+    build_window_index()
+
+
+def collect_training_results(jobs, results, writer):
+    """
+    Stores the results of the training jobs in the order they arrive and returns them as columns,
+    together with the name of the last model and the latest cache counters of every process
+    """
+    cols = {col: [] for col in watches}
+    cache_counters = {}
+    model_name = None
+    windows_per_settings = len(list(itertools.product(*windows_list)))
+    open_jobs_per_settings = Counter(job.i for job in jobs)
+    SSD_distributions = defaultdict(lambda: ([], []))
+
+    for result in results:
+        i, j, settings, runID = result.job.i, result.job.j, result.job.settings, result.job.runID
+        model_name = result.model_name
+        process_id, counters = result.cache_counters
+        cache_counters[process_id] = counters
+        store_training_result(result, writer)
+        for col in watches:
+            cols[col].append(result.row[col])
+
+        print('{}.{} {}: {}{}'.format(i, j, model_name, 'FAILED ' if result.row['failed'] else '',
+                                      result.row['duration'].seconds), end=' - ')
+        print(result.row['loss'])
+
+        SSD_distribution_train, SSD_distribution_val = SSD_distributions[i]
+        if result.SSD_train is not None:
+            SSD_distribution_train.append(result.SSD_train)
+            SSD_distribution_val.append(result.SSD_val)
+
+        open_jobs_per_settings[i] -= 1
+        if open_jobs_per_settings[i] == 0 and windows_per_settings >= 5:
+            store_SSD_distribution(settings, model_name, SSD_distribution_train, SSD_distribution_val, runID,
+                                   writer)
+            del SSD_distributions[i]
+
+    return cols, model_name, cache_counters
 
-    if run_BS != 'only_BS':
-
-        msg = 'Evaluating {} different settings with {} feature combinations, in {} windows, ' \
-              'each {} times for a total of {} runs.'
-        print(msg.format(int(settings_combi_count / len(active_feature_combinations)),
-                         len(active_feature_combinations),
-                         window_combi_count,
-                         identical_reruns,
-                         settings_combi_count * window_combi_count * identical_reruns
-                         ))
-
-        watches = ['model_name', 'time', 'optimizer', 'lr', 'epochs', 'features', 'activation', 'layers', 'nodes',
-                   'batch_normalization', 'loss', 'loss_oos', 'used_synth', 'normalize', 'dropout', 'batch_size',
-                   'failed', 'loss_mean', 'loss_std', 'val_loss_mean', 'val_loss_std', 'stock', 'dt_start', 'dt_middle',
-                   'dt_end', 'duration', 'N_train', 'N_val', 'regularizer', 'useEarlyStopping', 'loss_func', 'MSHE',
-                   'MSHE_oos', 'MAPHE', 'MAPHE_oos']
-
-        cols = {col: [] for col in watches}
-
-        i = 0
-        for settings in itertools.product(*settings_list):  # equivalent to a bunch of nested for-loops
-            i += 1
-            SSD_distribution_train = []
-            SSD_distribution_val = []
-            (act, n, layers, optimizer, include_synthetic_data, dropout_rate,
-             normalization, batch_size, regularizer, c) = settings
-            used_features = full_feature_combination_list[c]
-            if type(layers) is tuple:
-                shared_layers, individual_layers = layers
-                layers = shared_layers + individual_layers
-            j = 0
-            for window in itertools.product(*windows_list):
-                j += 1
-                stock, date_tuple, rerun_id = window
-                dt_start, dt_middle, dt_end = date_tuple
-
-                print('{}.{}'.format(i, j), end=' ', flush=True)
-
-                # We reinitialize these variables to None because they will be appended to cols
-                loss_oos = last_losses_mean = last_losses_std = last_val_losses_mean =\
-                    last_val_losses_std = None
-
-                pattern = 'c{}_act{}_lf{}_l{}_n{}_o{}_bn{}_do{}_s{}_no{}_bs{}_r{}'
-                model_name = pattern.format(c, act, loss_func, layers, n, optimizer, int(batch_normalization),
-                                            int(dropout_rate*10), int(include_synthetic_data),
-                                            normalization, batch_size, regularizer)
-
-                if multi_target:
-                    model_name = 'multit_'+model_name
-                    print(model_name, end=': ', flush=True)
-
-                    model = multitask_model(input_dim=len(used_features), shared_layers=shared_layers,
-                                            individual_layers=individual_layers, nodes_per_layer=n,
-                                            activation=act, use_batch_normalization=batch_normalization,
-                                            optimizer=optimizer)
-                else:
-                    model_name = 'full_'+model_name
-                    print(model_name, end=': ', flush=True)
-
-                    model = full_model(input_dim=len(used_features), num_layers=layers, nodes_per_layer=n,
-                                       loss=loss_func, activation=act, optimizer=optimizer,
-                                       use_batch_normalization=batch_normalization,
-                                       dropout_rate=dropout_rate, regularizer=regularizer)
-
-                model.name = model_name
 
-                # when rerun_id is 0, that means we just switched to a new stock or date, or setting
-                # that is when we need to get the data again
-                if rerun_id == 0:
-
-                    data_package = get_data_package(
-                        model=model,
-                        columns=used_features,
-                        include_synth=include_synthetic_data,
-                        normalize=normalization,
+def perform_experiment():
+    runID, completed_job_keys, BS_completed_job_keys = get_run()
+    init_training_process()
+    cache_counters = {}
+
+    with AsyncWriter() as result_writer:
+        if run_BS != 'only_BS':
+
+            msg = 'Evaluating {} different settings with {} feature combinations, in {} windows, ' \
+                  'each {} times for a total of {} runs.'
+            print(msg.format(int(settings_combi_count / len(active_feature_combinations)),
+                             len(active_feature_combinations),
+                             window_combi_count,
+                             identical_reruns,
+                             settings_combi_count * window_combi_count * identical_reruns
+                             ))
+
+            jobs = list(get_training_jobs(runID, completed_job_keys))
+            job_groups = get_job_groups(jobs)
+            pool = get_fork_pool(training_workers)
+            if pool is None:
+                if prefetch_data_packages:
+                    results = train_jobs_with_prefetch(job_groups)
+                else:
+                    results = map(train_job_group, job_groups)
+            else:
+                print('Training in {} processes'.format(training_workers))
+                results = pool.imap_unordered(train_job_group, job_groups)
+            results = itertools.chain.from_iterable(results)
+
+            cols, model_name, cache_counters = collect_training_results(jobs, results, result_writer)
+
+            if pool is not None:
+                pool.close()
+                pool.join()
+
+            results_df = pd.DataFrame(cols)
+            results_df['runID'] = runID
+
+            if results_backend == 'excel' and limit_windows != 'mock-testing':
+                try:
+                    with pd.ExcelFile(paths['results-excel']) as reader:
+                        previous_results = reader.parse("RunData")
+                    merged_results = pd.concat([results_df, previous_results])
+                except FileNotFoundError:
+                    merged_results = results_df
+
+                with pd.ExcelWriter(paths['results-excel']) as writer:
+                    merged_results.to_excel(writer, 'RunData')
+                    writer.save()
+
+            # The plots read the stored outputs
+            result_writer.flush()
+            print('ANN calculations done')
+            if not onCluster:
+                if cols['failed'] and not cols['failed'][-1]:
+                    get_and_plot([model_name+'_inSample', model_name+'_outSample'], variable='prediction')
+                    get_and_plot([model_name+'_inSample', model_name+'_outSample'], variable='error')
+                    get_and_plot([model_name+'_inSample', model_name+'_outSample'], variable='calculated_delta')
+                    get_and_plot([model_name+'_inSample', model_name+'_outSample'], variable='scaled_option_price')
+
+        if run_BS in ['yes', 'only_BS']:  # not 'no'
+            print('Running Black Scholes Benchmark')
+
+            BS_watches = ['stock', 'dt_start', 'dt_middle', 'dt_end', 'vol_proxy', 'MSE', 'MAE', 'MAPE', 'MSHE',
+                          'MAPHE']
+            BS_cols = {col: [] for col in BS_watches}
+
+            i = 0
+            for vol_proxy in vol_proxies:
+                i += 1
+                j = 0
+                for window in itertools.product(*windows_list):
+                    j += 1
+
+                    print('{}.{}'.format(i, j), end=' ', flush=True)
+                    stock, date_tuple, rerun_id = window
+                    dt_start, dt_middle, dt_end = date_tuple
+
+                    job_key = get_job_key(vol_proxy, int(stock), date_tuple, rerun_id)
+                    if job_key in BS_completed_job_keys:
+                        print('already done')
+                        continue
+
+                    data_package = data_package_cache.get_data_package(
+                        model='BS',
+                        columns=['days', 'moneyness', 'impl_volatility', 'v60', 'r'],
                         stock=stock,
                         start_date=dt_start,
                         end_train_start_val_date=dt_middle,
                         end_val_date=dt_end
                     )
-                    N_train = len(data_package[0][0])
-                    N_val = len(data_package[0][2])
-
-                if lr is not None:
-                    K.set_value(model.optimizer.lr, lr)
-
-                actual_epochs = epochs
-                starting_time = datetime.now()
-                starting_time_str = '{:%Y-%m-%d_%H-%M}'.format(starting_time)
-
-                annResult = run_and_store_ann(model=model, in_sample=True, model_name='i_' + model_name + '_inSample',
-                                              nb_epochs=separate_initial_epochs, reset='yes', columns=used_features,
-                                              include_synth=include_synthetic_data, normalize=normalization,
-                                              batch_size=batch_size, data_package=data_package,
-                                              starting_time_str=starting_time_str)
-                initial_hist = annResult.history
-                initial_loss = annResult.last_loss
-
-                # During early experimentation it was useful to quickly abort models that failed to converge
-                if initial_loss > required_precision:
-                    print('FAILED', end=' ')
-                    cols['failed'].append(int(True))
-                    loss = initial_loss
-                    if useEarlyStopping:
-                        actual_epochs = len(initial_hist.history['loss'])
-
-                else:
-                    cols['failed'].append(int(False))
-                    annResult = run_and_store_ann(model=model, in_sample=True, model_name=model_name + '_inSample',
-                                                  nb_epochs=epochs - separate_initial_epochs, reset='continue',
-                                                  columns=used_features, get_deltas=True,
-                                                  include_synth=include_synthetic_data, normalize=normalization,
-                                                  batch_size=batch_size, data_package=data_package,
-                                                  starting_time_str=starting_time_str)
-                    hist, loss, loss_tuple, MSHE, MAPHE = annResult
-
-                    annResult = run_and_store_ann(model=model, in_sample=False, model_name=model_name + '_outSample',
-                                                  reset='reuse', columns=used_features, get_deltas=True,
-                                                  normalize=normalization, batch_size=batch_size,
-                                                  data_package=data_package, starting_time_str=starting_time_str)
-                    loss_oos = annResult.last_loss
-                    MSHE_oos = annResult.MSHE
-                    MAPHE_oos = annResult.MAPHE
-
-                    if useEarlyStopping:
-                        actual_epochs = len(hist.history['loss'])+len(initial_hist.history['loss'])
-
-                    (last_losses_mean, last_losses_std, last_val_losses_mean, last_val_losses_std) = loss_tuple
-
-                    data = data_package.data
-                    scaler_X = data_package.scaler_X
-                    X_train = data[0]
-                    X_val = data[2]
-                    SSD_train = get_ssd(model, X_train)
-                    SSD_val = get_ssd(model, X_val)
-                    SSD_distribution_train.append(SSD_train)
-                    SSD_distribution_val.append(SSD_val)
-
-                model_end_time = datetime.now()
-
-                feature_string = '_'.join(used_features)
-                pos_fff = feature_string.find("_ff_ind")
-                # reducing the long string of fama & french factors down
-                if pos_fff > -1:
-                    feature_string = feature_string[0:pos_fff] + "_fff"
-
-                cols['model_name'].append(model_name)
-                cols['time'].append(datetime.now())
-                cols['duration'].append(model_end_time - starting_time)
-                cols['N_train'].append(N_train)
-                cols['N_val'].append(N_val)
-
-                cols['stock'].append(stock)
-                cols['dt_start'].append(dt_start)
-                cols['dt_middle'].append(dt_middle)
-                cols['dt_end'].append(dt_end)
-
-                cols['loss'].append(loss)
-                cols['loss_oos'].append(loss_oos)
-                cols['loss_mean'].append(last_losses_mean)
-                cols['loss_std'].append(last_losses_std)
-                cols['val_loss_mean'].append(last_val_losses_mean)
-                cols['val_loss_std'].append(last_val_losses_std)
-                cols['MSHE'].append(MSHE)
-                cols['MSHE_oos'].append(MSHE_oos)
-                cols['MAPHE'].append(MAPHE)
-                cols['MAPHE_oos'].append(MAPHE_oos)
-
-                cols['epochs'].append(actual_epochs)
-                cols['optimizer'].append(optimizer)
-                cols['lr'].append(lr)
-                cols['features'].append(feature_string)
-                cols['activation'].append(act)
-                cols['layers'].append(layers)
-                cols['nodes'].append(n)
-                cols['batch_normalization'].append(batch_normalization)
-                cols['loss_func'].append(loss_func)
-
-                cols['used_synth'].append(int(include_synthetic_data))
-                cols['normalize'].append(normalization)
-                cols['dropout'].append(dropout_rate)
-                cols['batch_size'].append(batch_size)
-                cols['regularizer'].append(regularizer)
-                cols['useEarlyStopping'].append(int(useEarlyStopping))
-
-                print((model_end_time - starting_time).seconds, end=' - ')
-                print(loss)
-
-                filename = model_name + '_' + starting_time_str + '.h5'
-                model.save(os.path.join(paths['all_models'], filename))
-
-                if i == 1 and j == i:
-                    # sample model to be particularly investigated
-
-                    loss, Y_prediction, history = run(model,
-                                                      data=data,
-                                                      reset='reuse',
-                                                      plot_prediction=False,
-                                                      segment_plot=False,
-                                                      verbose=0,
-                                                      model_name=model_name,
-                                                      in_sample=False,
-                                                      batch_size=batch_size,
-                                                      starting_time_str=starting_time_str)
-
-                    model.save(paths['sample_model'])
-                    with pd.HDFStore(paths['sample_data']) as store:
-                        store['X_train'] = X_train
-                        store['X_test'] = X_val
-                        store['Y_train'] = data[1]
-                        store['Y_test'] = data[3]
-                        store['Y_prediction'] = pd.Series(Y_prediction.flatten())
-
-                featureCounts_to_record = [len(full_feature_combination_list[-1])]
-                is_All_or_None_Run = len(used_features) in featureCounts_to_record
-                if collect_gradients_data and is_All_or_None_Run:
-                    gradient_df_columns = ['model_name', 'time', 'sample', 'feature', 'feature_value', 'gradient',
-                                           'stock', 'dt_start', 'runID', 'num_features', 'moneyness']
-                    
-                    grad_data = {key: [] for key in gradient_df_columns}
-
-                    sampling_dict = dict(train=X_train, test=X_val)
-
-                    for sample_key, points in sampling_dict.items():
-
-                        gradients = get_gradients(model, points)
-                        rescaled = scaler_X.inverse_transform(points)
-                        points = pd.DataFrame(rescaled, index=points.index, columns=points.columns)
-
-                        for feature_iloc, feature_name in enumerate(points.columns):
-                            iterator = zip(
-                                points.iloc[:, feature_iloc],
-                                gradients[:, feature_iloc],
-                                points.loc[:, 'moneyness']
-                            )
-                            for value, gradient, moneyness in iterator:
-                                grad_data['model_name'].append(model_name)
-                                grad_data['time'].append(starting_time)
-                                grad_data['sample'].append(sample_key)
-                                grad_data['feature'].append(feature_name)
-                                grad_data['feature_value'].append(value)
-                                grad_data['gradient'].append(gradient)
-                                grad_data['stock'].append(stock)
-                                grad_data['dt_start'].append(dt_start)
-                                grad_data['runID'].append(runID)
-                                grad_data['num_features'].append(len(points.columns))
-                                grad_data['moneyness'].append(moneyness)
-
-                    gradients_df = pd.DataFrame(grad_data)
-
-                    if limit_windows != 'mock-testing':
-
-                        with pd.HDFStore(paths['gradients_data'], mode='a') as store:
-                            store.append('gradients_data', gradients_df, index=False, data_columns=True)
-
-                K.clear_session()
-                tf.reset_default_graph()
-
-            if j >= 5:
-                if not onCluster and len(used_features) > 4:
-                    boxplot_SSD_distribution(SSD_distribution_train, used_features, 'Training Data', model_name)
-                    boxplot_SSD_distribution(SSD_distribution_val, used_features, 'Validation Data', model_name)
-
-                if saveResultsForLatex:
-                    SSDD_df_train = pd.DataFrame(SSD_distribution_train, columns=used_features)
-                    SSDD_df_val = pd.DataFrame(SSD_distribution_val, columns=used_features)
-                    SSDD_df_train['sample'] = 'train'
-                    SSDD_df_val['sample'] = 'test'
-                    merged_results = pd.concat([SSDD_df_train, SSDD_df_val])
-                    merged_results['runID'] = runID
-                    merged_results['used_synth'] = include_synthetic_data
-
-                    try:
-                        with pd.HDFStore(paths['data_for_latex']) as store:
-                            previous_results = store['SSDD_df']
-                            merged_results = pd.concat([merged_results, previous_results])
-                    except FileNotFoundError:
-                        pass
-
-                    with pd.HDFStore(paths['data_for_latex']) as store:
-                        store['SSDD_df'] = merged_results
-
-        results_df = pd.DataFrame(cols)
-        results_df['runID'] = runID
-
-        if limit_windows != 'mock-testing':
-            try:
-                with pd.ExcelFile(paths['results-excel']) as reader:
-                    previous_results = reader.parse("RunData")
-                merged_results = pd.concat([results_df, previous_results])
-            except FileNotFoundError:
-                merged_results = results_df
-
-            with pd.ExcelWriter(paths['results-excel']) as writer:
-                merged_results.to_excel(writer, 'RunData')
-                writer.save()
-
-        print('ANN calculations done')
-        if not onCluster:
-            if not cols['failed'][-1]:
-                get_and_plot([model_name+'_inSample', model_name+'_outSample'], variable='prediction')
-                get_and_plot([model_name+'_inSample', model_name+'_outSample'], variable='error')
-                get_and_plot([model_name+'_inSample', model_name+'_outSample'], variable='calculated_delta')
-                get_and_plot([model_name+'_inSample', model_name+'_outSample'], variable='scaled_option_price')
-
-    if run_BS in ['yes', 'only_BS']:  # not 'no'
-        print('Running Black Scholes Benchmark')
-
-        BS_watches = ['stock', 'dt_start', 'dt_middle', 'dt_end', 'vol_proxy', 'MSE', 'MAE', 'MAPE', 'MSHE', 'MAPHE']
-        BS_cols = {col: [] for col in BS_watches}
-
-        i = 0
-        for vol_proxy in vol_proxies:
-            i += 1
-            j = 0
-            for window in itertools.product(*windows_list):
-                j += 1
-
-                print('{}.{}'.format(i, j), end=' ', flush=True)
-                stock, date_tuple, rerun_id = window
-                dt_start, dt_middle, dt_end = date_tuple
-                data_package = get_data_package(
-                    model='BS',
-                    columns=['days', 'moneyness', 'impl_volatility', 'v60', 'r'],
-                    stock=stock,
-                    start_date=dt_start,
-                    end_train_start_val_date=dt_middle,
-                    end_val_date=dt_end
-                )
-                MSE, MAE, MAPE, MSHE, MAPHE = run_black_scholes(data_package, vol_proxy=vol_proxy)
-                print(MSE)
-
-                BS_cols['stock'].append(stock)
-                BS_cols['dt_start'].append(dt_start)
-                BS_cols['dt_middle'].append(dt_middle)
-                BS_cols['dt_end'].append(dt_end)
-                BS_cols['vol_proxy'].append(vol_proxy)
-                BS_cols['MSE'].append(MSE)
-                BS_cols['MAE'].append(MAE)
-                BS_cols['MAPE'].append(MAPE)
-                BS_cols['MSHE'].append(MSHE)
-                BS_cols['MAPHE'].append(MAPHE)
-
-        BS_results_df = pd.DataFrame(BS_cols)
-
-        if limit_windows != 'mock-testing':
-            try:
-                with pd.ExcelFile(paths['results-excel-BS']) as reader:
-                    BS_previous_results = reader.parse("RunData")
-                if run_BS == 'only_BS':
-                    BS_results_df['runID'] = BS_previous_results.runID.max()+1
-                else:
-                    BS_results_df['runID'] = runID
-                BS_merged_results = pd.concat([BS_results_df, BS_previous_results])
-            except FileNotFoundError:
-                BS_results_df['runID'] = 1
-                BS_merged_results = BS_results_df
-
-            with pd.ExcelWriter(paths['results-excel-BS']) as writer:
-                BS_merged_results.to_excel(writer, 'RunData')
-                writer.save()
-        print('BS done')
-
+                    MSE, MAE, MAPE, MSHE, MAPHE = run_black_scholes(data_package, vol_proxy=vol_proxy)
+                    print(MSE)
+
+                    BS_cols['stock'].append(stock)
+                    BS_cols['dt_start'].append(dt_start)
+                    BS_cols['dt_middle'].append(dt_middle)
+                    BS_cols['dt_end'].append(dt_end)
+                    BS_cols['vol_proxy'].append(vol_proxy)
+                    BS_cols['MSE'].append(MSE)
+                    BS_cols['MAE'].append(MAE)
+                    BS_cols['MAPE'].append(MAPE)
+                    BS_cols['MSHE'].append(MSHE)
+                    BS_cols['MAPHE'].append(MAPHE)
+
+                    if results_backend == 'sqlite' and limit_windows != 'mock-testing':
+                        row = {col: values[-1] for col, values in BS_cols.items()}
+                        row['runID'] = runID
+                        row['job_key'] = job_key
+                        result_writer.submit(partial(append_results, [row], 'BSRunData'))
+
+            BS_results_df = pd.DataFrame(BS_cols)
+
+            if results_backend == 'excel' and limit_windows != 'mock-testing':
+                try:
+                    with pd.ExcelFile(paths['results-excel-BS']) as reader:
+                        BS_previous_results = reader.parse("RunData")
+                    if run_BS == 'only_BS':
+                        BS_results_df['runID'] = BS_previous_results.runID.max()+1
+                    else:
+                        BS_results_df['runID'] = runID
+                    BS_merged_results = pd.concat([BS_results_df, BS_previous_results])
+                except FileNotFoundError:
+                    BS_results_df['runID'] = 1
+                    BS_merged_results = BS_results_df
+
+                with pd.ExcelWriter(paths['results-excel-BS']) as writer:
+                    BS_merged_results.to_excel(writer, 'RunData')
+                    writer.save()
+            print('BS done')
+
+    print(get_cache_report(cache_counters))
     print('Close')
 
 
@@ -0,0 +1,105 @@
+import sys
+import json
+import threading
+from collections import OrderedDict
+import pandas as pd
+
+from config import paths, loaded_models_capacity
+from results_store import connect, append_results, get_table_columns, to_sql_value
+
+# Every saved model is registered in the Models table of results.sqlite together with its settings,
+# features, window, losses and file path, so that models can be found by a query instead of by
+# globbing the all_models directories and parsing their filenames, e.g.
+#   find_models(stock=10107, dt_start='2014-01-01', feature_set=3)
+#   python model_registry.py stock=10107 feature_set=3
+
+registry_table = 'Models'
+
+
+def register_model(record, db_path=paths['results-db']):
+    append_results([record], registry_table, db_path)
+
+
+def get_model_record(file_path, scalers_path, feature_set, used_features, rerun_id):
+    # Registry fields that are not already part of the result row
+    return {
+        'file_path': file_path,
+        'scalers_path': scalers_path,
+        'feature_set': feature_set,
+        'used_features': json.dumps(list(used_features)),
+        'rerun_id': rerun_id,
+    }
+
+
+def find_models(db_path=paths['results-db'], **conditions):
+    """
+    Registered models matching all conditions (column=value), the most recently trained first
+    """
+    with connect(db_path) as con:
+        columns = get_table_columns(con, registry_table)
+        if not columns:
+            return pd.DataFrame()
+        unknown_columns = set(conditions) - set(columns)
+        if unknown_columns:
+            raise ValueError('Unknown registry columns: {}'.format(unknown_columns))
+
+        query = 'SELECT * FROM "{}"'.format(registry_table)
+        if conditions:
+            query += ' WHERE ' + ' AND '.join('"{}" IS ?'.format(col) for col in conditions)
+        query += ' ORDER BY time DESC'
+        models = pd.read_sql(query, con, params=[to_sql_value(value) for value in conditions.values()])
+    if 'used_features' in models:
+        models['used_features'] = models['used_features'].map(json.loads)
+    return models
+
+
+def parse_conditions(arguments):
+    # column=value arguments of the command line, integer values are compared as integers
+    conditions = dict(argument.split('=', 1) for argument in arguments)
+    return {col: int(value) if value.lstrip('-').isdigit() else value for col, value in conditions.items()}
+
+
+def load_keras_model(path):
+    from keras.models import load_model
+    return load_model(path)
+
+
+class ModelLoader:
+    """
+    Loads registered models on first use and keeps the capacity most recently used ones in memory
+    """
+    def __init__(self, capacity=loaded_models_capacity, load_function=load_keras_model,
+                 db_path=paths['results-db']):
+        self.capacity = capacity
+        self.load_function = load_function
+        self.db_path = db_path
+        self.models = OrderedDict()
+        self.lock = threading.Lock()
+
+    def load(self, file_path):
+        with self.lock:
+            if file_path in self.models:
+                self.models.move_to_end(file_path)
+                return self.models[file_path]
+            model = self.load_function(file_path)
+            self.models[file_path] = model
+            while len(self.models) > self.capacity:
+                self.models.popitem(last=False)
+            return model
+
+    def get(self, **conditions):
+        """
+        The most recently trained model matching the conditions, see find_models
+        """
+        models = find_models(self.db_path, **conditions)
+        if models.empty:
+            raise KeyError('No registered model matches {}'.format(conditions))
+        return self.load(models['file_path'].iloc[0])
+
+
+if __name__ == '__main__':
+    # python model_registry.py [column=value ...]
+    conditions = parse_conditions(sys.argv[1:])
+    with pd.option_context('display.width', 200, 'display.max_columns', 12):
+        print(find_models(**conditions)[['model_name', 'stock', 'dt_start', 'features', 'loss', 'loss_oos',
+                                         'file_path']])
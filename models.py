@@ -1,14 +1,42 @@
 from scipy.stats import norm
 import numpy as np
+import weakref
 from keras.models import Sequential
-from keras import layers, models, regularizers
+from keras import layers, models, regularizers, activations, initializers, losses
 from keras.layers import Dense, Dropout
 from keras.utils import plot_model
 from keras import backend as K
 from keras.engine.topology import Layer
 import tensorflow as tf
 
-from config import paths, onCluster
+from config import onCluster
+
+# The initial weights of every model are kept in memory, so that run(reset='yes') can restore them
+initial_weights = weakref.WeakKeyDictionary()
+
+
+def snapshot_weights(model):
+    initial_weights[model] = model.get_weights()
+
+
+def restore_initial_weights(model):
+    model.set_weights(initial_weights[model])
+
+
+model_initializers = weakref.WeakKeyDictionary()
+
+
+def reinitialize_model(model):
+    """
+    Draws new initial weights and resets the optimizer state, as if the model had just been built
+    """
+    # The optimizer creates its variables with the first fit, the initializer is recreated once they exist
+    variables = model.weights + model.optimizer.weights
+    if model not in model_initializers or model_initializers[model][0] != len(variables):
+        model_initializers[model] = (len(variables), tf.variables_initializer(variables))
+    K.get_session().run(model_initializers[model][1])
+    snapshot_weights(model)
+
 
 def full_model(input_dim=2, num_layers=5, nodes_per_layer = 200, loss='mape', activation='relu', optimizer='adam',
                dropout_rate=0, use_batch_normalization=False, regularizer=None):
@@ -29,12 +57,125 @@ def full_model(input_dim=2, num_layers=5, nodes_per_layer = 200, loss='mape', ac
     metrics = ['mse', 'mae', 'mape']
     metrics.remove(loss)
     model.compile(optimizer=optimizer, loss=loss, metrics=metrics)
-    model.save_weights(paths['weights'])
+    snapshot_weights(model)
     if not onCluster:
         plot_model(model, to_file='model-diagrams/model-f.png')
     return model
 
 
+class StackedDense(Layer):
+    """
+    Independent Dense layers of several ensemble members, (batch, members, input_dim) -> (batch, members, units)
+    """
+    def __init__(self, units, activation=None, kernel_initializer='RandomNormal', kernel_regularizer=None, **kwargs):
+        self.units = units
+        self.activation = activations.get(activation)
+        self.kernel_initializer = initializers.get(kernel_initializer)
+        self.kernel_regularizer = regularizers.get(kernel_regularizer)
+        super(StackedDense, self).__init__(**kwargs)
+
+    def build(self, input_shape):
+        members, input_dim = int(input_shape[1]), int(input_shape[2])
+        self.kernel = self.add_weight(name='kernel',
+                                      shape=(members, input_dim, self.units),
+                                      initializer=self.kernel_initializer,
+                                      regularizer=self.kernel_regularizer)
+        self.bias = self.add_weight(name='bias',
+                                    shape=(members, self.units),
+                                    initializer='zeros')
+        super(StackedDense, self).build(input_shape)
+
+    def call(self, x):
+        # One batched matmul over the members: (members, batch, input_dim) x (members, input_dim, units)
+        output = tf.matmul(tf.transpose(x, [1, 0, 2]), self.kernel)
+        output = tf.transpose(output, [1, 0, 2]) + self.bias
+        return self.activation(output)
+
+    def compute_output_shape(self, input_shape):
+        return input_shape[0], input_shape[1], self.units
+
+    def get_config(self):
+        config = {
+            'units': self.units,
+            'activation': activations.serialize(self.activation),
+            'kernel_initializer': initializers.serialize(self.kernel_initializer),
+            'kernel_regularizer': regularizers.serialize(self.kernel_regularizer),
+        }
+        base_config = super(StackedDense, self).get_config()
+        return dict(list(base_config.items()) + list(config.items()))
+
+
+def get_member_losses(member_loss, y_true, y_pred):
+    """
+    Losses of all rows and members, (batch, members). The targets of an ensemble_model hold the sample weight of
+    every row and member next to the target, see stack_data_packages, padded rows have weight 0. Scaled so that
+    their mean over the batch is every member's mean loss on its own rows of the batch
+    """
+    target, weight = y_true[..., :1], y_true[..., 1]
+    rows = K.cast(K.shape(weight)[0], K.floatx())
+    member_rows = K.maximum(K.sum(weight, axis=0, keepdims=True), 1)
+    return member_loss(target, y_pred) * weight * rows / member_rows
+
+
+def ensemble_loss(loss):
+    member_loss = losses.get(loss)
+
+    # Summed instead of averaged over the members, so every member gets the gradient it would get alone
+    def summed_member_loss(y_true, y_pred):
+        return K.sum(get_member_losses(member_loss, y_true, y_pred), axis=-1)
+    summed_member_loss.__name__ = 'ensemble_' + member_loss.__name__
+    return summed_member_loss
+
+
+def ensemble_member_loss(loss, member):
+    member_loss = losses.get(loss)
+
+    # Metric with the loss of a single member, its history is the history of the member
+    def single_member_loss(y_true, y_pred):
+        return get_member_losses(member_loss, y_true, y_pred)[:, member]
+    single_member_loss.__name__ = 'member_{}_loss'.format(member)
+    return single_member_loss
+
+
+def ensemble_model(members, input_dim=2, num_layers=5, nodes_per_layer=200, loss='mape', activation='relu',
+                   optimizer='adam', dropout_rate=0, use_batch_normalization=False, regularizer=None):
+    """
+    members copies of full_model with their own weights, trained by a single fit on stacked data
+    """
+    if use_batch_normalization:
+        raise NotImplementedError('batch normalization would share its statistics between the ensemble members')
+    if regularizer == 'l1':
+        regularizer = regularizers.l1(0.01)
+    if regularizer == 'l2':
+        regularizer = regularizers.l2(0.01)
+    options_input = layers.Input(shape=(members, input_dim))
+    current_layer = StackedDense(nodes_per_layer, activation=activation, kernel_regularizer=regularizer)(options_input)
+    for i in range(num_layers - 1):
+        if dropout_rate:
+            current_layer = Dropout(dropout_rate)(current_layer)
+        current_layer = StackedDense(nodes_per_layer, activation=activation)(current_layer)
+    out = StackedDense(1, kernel_initializer='normal')(current_layer)
+    model = models.Model(inputs=[options_input], outputs=out)
+    model.compile(optimizer=optimizer, loss=ensemble_loss(loss),
+                  metrics=[ensemble_member_loss(loss, member) for member in range(members)])
+    snapshot_weights(model)
+    return model
+
+
+def export_ensemble_member(ensemble, member, **architecture):
+    """
+    Returns member of an ensemble_model as a full_model with the given architecture
+    """
+    model = full_model(**architecture)
+    dense_layers = [layer for layer in model.layers if isinstance(layer, Dense)]
+    stacked_layers = [layer for layer in ensemble.layers if isinstance(layer, StackedDense)]
+    for dense_layer, stacked_layer in zip(dense_layers, stacked_layers):
+        kernel, bias = stacked_layer.get_weights()
+        dense_layer.set_weights([kernel[member], bias[member]])
+    snapshot_weights(model)
+    return model
+
+
 def black_scholes_pricer(m, t, r, s, option_type='call'):
     d1 = 1/(s*(t**(1/2)))*(np.log(1/m)+(r+(s**2)/2)*t)
     d2 = d1 - s*t**(1/2)
@@ -82,7 +223,7 @@ def multitask_model(input_dim=2, shared_layers=5, individual_layers=3, nodes_per
     out_right = layers.Dense(1, kernel_initializer='RandomNormal', activation=activation, name='hedger')(current_layer_right)
 
     model = models.Model(inputs=[options_input], outputs=[out_left, out_right])
-    model.save_weights(paths['weights'])
+    snapshot_weights(model)
     if not onCluster:
         plot_model(model, to_file='model-diagrams/model-mt.png')
     model.compile(optimizer=optimizer, loss='mse', metrics=['mae'], loss_weights=[1., 1.])
@@ -96,7 +237,7 @@ def rational_model(J=5):
     added = layers.Multiply()([y,w])
     out = layers.Dense(1, use_bias=False)(added)
     model = models.Model(inputs=[options_input], outputs=out)
-    model.save_weights(paths['weights'])
+    snapshot_weights(model)
     if not onCluster:
         plot_model(model, to_file='model-diagrams/rational.png')
     model.compile(optimizer='rmsprop', loss='mse', metrics=['mae'])
@@ -188,7 +329,7 @@ def rational_model_v2(J=5, asLayer=False):
     model = models.Model(inputs=[input], outputs=out)
     if asLayer:
         return model
-    model.save_weights(paths['weights'])
+    snapshot_weights(model)
     if not onCluster:
         plot_model(model, to_file='model-diagrams/rational_v2.png')
     model.compile(optimizer='rmsprop', loss='mse', metrics=['mae'])
@@ -211,7 +352,7 @@ def rational_multi_model(I=5, K=5, J=5):
     out = layers.Lambda(lambda x: backend.sum(x, axis=1), output_shape=(1,), name='sum')(mult)
     model = models.Model(inputs=[input], outputs=out)
 
-    model.save_weights(paths['weights'])
+    snapshot_weights(model)
     if not onCluster:
         plot_model(model, to_file='model-diagrams/rational_multi.png')
     model.compile(optimizer='sgd', loss='mse', metrics=['mae'])
@@ -225,7 +366,7 @@ def deep_model(layers=5, nodes_per_layer = 200, loss='mse', activation='relu'):
         model.add(Dense(nodes_per_layer, kernel_initializer='RandomNormal', activation=activation))
     model.add(Dense(1, kernel_initializer='normal'))
     model.compile(optimizer='rmsprop', loss=loss, metrics=['mae'])
-    model.save_weights(paths['weights'])
+    snapshot_weights(model)
     if not onCluster:
         plot_model(model, to_file='model-diagrams/model-d.png')
     return model
@@ -255,7 +396,7 @@ def stupid_model():
     model.add(Dense(1, kernel_initializer='normal'))
     #model.add(Dense(1,kernel_initializer='uniform',activation='softmax'))
     model.compile(optimizer='rmsprop', loss='mse', metrics=['mae'])
-    model.save_weights(paths['weights'])
+    snapshot_weights(model)
 
     if not onCluster:
         plot_model(model, to_file='model-diagrams/model-s.png')
@@ -269,7 +410,7 @@ def custom_model(J=20, activation='relu', loss='mse'):
     added = layers.Multiply()([y,w])
     out = layers.Dense(1, use_bias=False)(added)
     model = models.Model(inputs=[options_input], outputs=out)
-    model.save_weights(paths['weights'])
+    snapshot_weights(model)
     if not onCluster:
         plot_model(model, to_file='model-diagrams/custom.png')
     model.compile(optimizer='rmsprop', loss=loss, metrics=['mae'])
@@ -0,0 +1,241 @@
+import io
+import os
+import sys
+import pickle
+import numpy as np
+from collections import namedtuple
+
+# Trained full_models are exported to a small .npz file holding the weights of their Dense layers,
+# so that prices can be computed with NumPy alone, without the startup and call overhead of Keras.
+# Dropout is skipped since it is inactive at inference, BatchNormalization is folded into the next Dense
+# layer and the feature and price scalers are stored as elementwise affine maps.
+# Deltas, the input Jacobian and gamma are computed analytically in the same forward pass.
+# The features and fitted scalers of a saved .h5 model are pickled next to it (see get_scalers_path).
+
+activation_functions = {
+    'linear': lambda x: x,
+    'relu': lambda x: np.maximum(x, 0),
+    'elu': lambda x: np.where(x > 0, x, np.expm1(np.minimum(x, 0))),
+    'softplus': lambda x: np.logaddexp(x, 0),
+    'sigmoid': lambda x: 1 / (1 + np.exp(-x)),
+    'tanh': np.tanh,
+}
+
+
+def sigmoid_derivatives(x):
+    value = 1 / (1 + np.exp(-x))
+    slope = value * (1 - value)
+    return value, slope, slope * (1 - 2 * value)
+
+
+def tanh_derivatives(x):
+    value = np.tanh(x)
+    slope = 1 - value ** 2
+    return value, slope, -2 * value * slope
+
+
+def elu_derivatives(x):
+    exp = np.exp(np.minimum(x, 0))
+    return np.where(x > 0, x, exp - 1), np.where(x > 0, 1, exp), np.where(x > 0, 0, exp)
+
+
+def softplus_derivatives(x):
+    # softplus' = sigmoid
+    slope, bend, _ = sigmoid_derivatives(x)
+    return np.logaddexp(x, 0), slope, bend
+
+
+# Value, first and second derivative of every activation
+activation_derivatives = {
+    'linear': lambda x: (x, np.ones_like(x), np.zeros_like(x)),
+    'relu': lambda x: (np.maximum(x, 0), (x > 0).astype(x.dtype), np.zeros_like(x)),
+    'elu': elu_derivatives,
+    'softplus': softplus_derivatives,
+    'sigmoid': sigmoid_derivatives,
+    'tanh': tanh_derivatives,
+}
+
+Derivatives = namedtuple('Derivatives', 'value jacobian gamma')
+
+
+def get_affine_map(scaler, dim):
+    """
+    Returns (scale, offset) with scaler.transform(x) == x * scale + offset,
+    which holds for the MinMaxScaler, StandardScaler and RobustScaler
+    """
+    if scaler is None:
+        return np.ones(dim), np.zeros(dim)
+    offset = scaler.transform(np.zeros((1, dim)))[0]
+    scale = scaler.transform(np.ones((1, dim)))[0] - offset
+    return scale, offset
+
+
+def get_batch_normalization_map(layer):
+    config = layer.get_config()
+    weights = list(layer.get_weights())
+    gamma = weights.pop(0) if config['scale'] else 1
+    beta = weights.pop(0) if config['center'] else 0
+    moving_mean, moving_variance = weights
+    scale = gamma / np.sqrt(moving_variance + config['epsilon'])
+    return scale, beta - moving_mean * scale
+
+
+def export_full_model(model, path, features=None, scaler_X=None, scaler_Y=None):
+    kernels = []
+    biases = []
+    activations = []
+    input_scale = input_offset = None  # BatchNormalization waiting to be folded into the next Dense layer
+    for layer in model.layers:
+        layer_type = layer.__class__.__name__
+        if layer_type == 'Dropout':
+            continue
+        elif layer_type == 'BatchNormalization':
+            scale, offset = get_batch_normalization_map(layer)
+            if input_scale is not None:
+                scale, offset = input_scale * scale, input_offset * scale + offset
+            input_scale, input_offset = scale, offset
+        elif layer_type == 'Dense':
+            config = layer.get_config()
+            kernel, bias = layer.get_weights() if config['use_bias'] else (layer.get_weights()[0], 0)
+            if input_scale is not None:
+                bias = input_offset @ kernel + bias
+                kernel = input_scale[:, np.newaxis] * kernel
+                input_scale = input_offset = None
+            kernels.append(np.asarray(kernel, dtype=np.float32))
+            biases.append(np.asarray(bias, dtype=np.float32) * np.ones(kernel.shape[1], dtype=np.float32))
+            activations.append(config['activation'])
+        else:
+            raise ValueError('Layers of type {} cannot be exported'.format(layer_type))
+    if input_scale is not None:
+        raise ValueError('A BatchNormalization layer after the last Dense layer cannot be folded')
+
+    unknown_activations = set(activations) - set(activation_functions)
+    if unknown_activations:
+        raise ValueError('Unsupported activations: {}'.format(unknown_activations))
+
+    x_scale, x_offset = get_affine_map(scaler_X, kernels[0].shape[0])
+    y_scale, y_offset = get_affine_map(scaler_Y, kernels[-1].shape[1])
+    arrays = {'kernel_{}'.format(i): kernel for i, kernel in enumerate(kernels)}
+    arrays.update({'bias_{}'.format(i): bias for i, bias in enumerate(biases)})
+    np.savez(path, activations=np.array(activations), features=np.array(features or [], dtype=str),
+             x_scale=x_scale, x_offset=x_offset, y_scale=y_scale, y_offset=y_offset, **arrays)
+
+
+def get_scalers_path(model_path):
+    return os.path.splitext(model_path)[0] + '_scalers.pkl'
+
+
+def export_saved_model(model_path, path):
+    """
+    Exports a saved .h5 full_model together with the features and scalers stored next to it
+    """
+    from keras.models import load_model
+    scalers = {}
+    if os.path.exists(get_scalers_path(model_path)):
+        with open(get_scalers_path(model_path), 'rb') as f:
+            scalers = pickle.load(f)
+    export_full_model(load_model(model_path), path, **scalers)
+
+
+def load_saved_model(model_path):
+    """
+    NumpyMLP of an .npz export, or of a saved .h5 full_model which is exported in memory first
+    """
+    if model_path.endswith('.npz'):
+        return NumpyMLP(model_path)
+    exported = io.BytesIO()
+    export_saved_model(model_path, exported)
+    exported.seek(0)
+    return NumpyMLP(exported)
+
+
+class NumpyMLP:
+    """
+    Inference engine for models written by export_full_model
+    """
+    def __init__(self, path):
+        with np.load(path) as archive:
+            self.activations = [str(name) for name in archive['activations']]
+            self.kernels = [archive['kernel_{}'.format(i)] for i in range(len(self.activations))]
+            self.biases = [archive['bias_{}'.format(i)] for i in range(len(self.activations))]
+            self.features = [str(feature) for feature in archive['features']]
+            self.x_scale, self.x_offset = archive['x_scale'], archive['x_offset']
+            self.y_scale, self.y_offset = archive['y_scale'], archive['y_offset']
+
+    def predict(self, X):
+        """
+        Same as model.predict, from scaled inputs to scaled outputs
+        """
+        output = np.asarray(X, dtype=np.float32)
+        for kernel, bias, activation in zip(self.kernels, self.biases, self.activations):
+            output = activation_functions[activation](output @ kernel + bias)
+        return output
+
+    def derivatives(self, X, gamma_input=None, batch_size=10000):
+        """
+        Output, its gradient with respect to all inputs and optionally its second derivative with respect
+        to input number gamma_input, computed in forward mode on scaled inputs like predict
+        """
+        X = np.asarray(X, dtype=np.float32)
+        parts = [self.derivatives_of_batch(X[start:start + batch_size], gamma_input)
+                 for start in range(0, len(X), batch_size)]
+        value, jacobian, gamma = (np.concatenate(part) if part[0] is not None else None for part in zip(*parts))
+        return Derivatives(value, jacobian, gamma)
+
+    def derivatives_of_batch(self, X, gamma_input=None):
+        value = X
+        # Derivatives of every unit with respect to every input, shape (points, inputs, units)
+        tangent = np.broadcast_to(np.eye(X.shape[1], dtype=np.float32), (len(X),) + (X.shape[1],) * 2)
+        curvature = None if gamma_input is None else np.zeros(X.shape, dtype=np.float32)
+        for kernel, bias, activation in zip(self.kernels, self.biases, self.activations):
+            value, slope, bend = activation_derivatives[activation](value @ kernel + bias)
+            tangent = tangent @ kernel
+            if curvature is not None:
+                curvature = bend * tangent[:, gamma_input, :] ** 2 + slope * (curvature @ kernel)
+            tangent = slope[:, np.newaxis, :] * tangent
+        return Derivatives(value[:, 0], tangent[:, :, 0], None if curvature is None else curvature[:, 0])
+
+    def ssd(self, X):
+        """
+        Mean squared input gradients on scaled inputs, same as actions.get_ssd
+        """
+        return np.square(self.derivatives(X).jacobian).mean(axis=0)
+
+    def get_feature_position(self, feature):
+        return self.features.index(feature) if isinstance(feature, str) else feature
+
+    def price_derivatives(self, features, gamma_feature=None):
+        """
+        Price, its gradient with respect to the unscaled features and optionally its second derivative
+        with respect to gamma_feature, the scalers are taken into account by the chain rule
+        """
+        gamma_input = None if gamma_feature is None else self.get_feature_position(gamma_feature)
+        value, jacobian, gamma = self.derivatives(self.scale_features(features), gamma_input)
+        price = (value - self.y_offset) / self.y_scale
+        jacobian = jacobian * self.x_scale / self.y_scale
+        if gamma is not None:
+            gamma = gamma * self.x_scale[gamma_input] ** 2 / self.y_scale
+        return Derivatives(price, jacobian, gamma)
+
+    def delta(self, features):
+        """
+        Derivative of the price with respect to moneyness, e.g. to compute hedging errors without TensorFlow
+        """
+        return self.price_derivatives(features).jacobian[:, self.get_feature_position('moneyness')]
+
+    def scale_features(self, features):
+        if hasattr(features, 'columns') and self.features:
+            features = features[self.features]
+        return np.asarray(features, dtype=np.float64) * self.x_scale + self.x_offset
+
+    def price(self, features):
+        """
+        Option prices (as scaled_option_price) of unscaled features, the scalers are applied as in training
+        """
+        prediction = self.predict(self.scale_features(features)).astype(np.float64)
+        return ((prediction - self.y_offset) / self.y_scale)[:, 0]
+
+
+if __name__ == '__main__':
+    # python numpy_inference.py <model.h5> <model.npz>
+    export_saved_model(sys.argv[1], sys.argv[2])
@@ -6,6 +6,7 @@ import plotly.graph_objs as go
 import os
 
 from config import paths
+from async_writer import read_hdf_shards
 
 def actual_vs_fitted_plot(model, prediction_input_data, prediction_target, segment_plot, X_val, Y_prediction,
                           sample_size, offset):
@@ -32,11 +33,11 @@ def actual_vs_fitted_plot(model, prediction_input_data, prediction_target, segme
     plt.show()
 
 def get_data_description():
-    from data import data
+    from data import get_full_dataset
     from config import full_feature_combination_list
 
     cols = ['option_price'] + full_feature_combination_list[-1]
-    relevant_data = data.loc[:, cols]
+    relevant_data = get_full_dataset(cols)
     relevant_data.loc[:, 'days'] = np.int_(relevant_data.loc[:, 'days'])
 
     desc_df = pd.DataFrame(index=relevant_data.columns)
@@ -61,10 +62,10 @@ def get_data_description():
 def heatmapplot_correlations():
     from matplotlib import pyplot as plt
     import numpy as np
-    from data import data
+    from data import get_full_dataset
     from config import full_feature_combination_list
     columns_to_be_included_in_covar_calc = ['option_price'] + full_feature_combination_list[-1]
-    relevant_data = data.loc[:,columns_to_be_included_in_covar_calc]
+    relevant_data = get_full_dataset(columns_to_be_included_in_covar_calc)
     relevant_data.loc[:, 'days'] = np.int_(relevant_data.loc[:,'days'])
 
     covars = relevant_data.cov()
@@ -119,10 +120,16 @@ def scatterplot_PAD(model, datasets, id):
 
 
 def plot_histogram_of_results_by_feature(runID=3):
-    with pd.ExcelFile(paths['results-excel']) as reader:
-        previous_results = reader.parse("RunData")
-    with pd.ExcelFile(paths['results-excel-BS']) as reader:
-        BS_results = reader.parse("RunData")
+    from config import results_backend
+    if results_backend == 'sqlite':
+        from results_store import read_results
+        previous_results = read_results('RunData')
+        BS_results = read_results('BSRunData')
+    else:
+        with pd.ExcelFile(paths['results-excel']) as reader:
+            previous_results = reader.parse("RunData")
+        with pd.ExcelFile(paths['results-excel-BS']) as reader:
+            BS_results = reader.parse("RunData")
 
     df = previous_results.loc[previous_results.runID == runID]
     df_BS = BS_results.loc[BS_results.runID == runID]
@@ -330,10 +337,7 @@ def vol_surface_plot(input_data, setNames=None, variable='impl_volatility'):
 
 
 def get_and_plot(setNames, variable='error'):
-    data = []
-    store = pd.HDFStore(paths['neural_net_output'])
-    for setName in setNames:
-        data.append(store[setName])
+    # The latest output written under each name
+    data = [read_hdf_shards(paths['neural_net_output'], setName)[-1] for setName in setNames]
     vol_surface_plot(input_data=data, setNames=setNames, variable=variable)
-    store.close()
 
@@ -0,0 +1,209 @@
+import sys
+import json
+import time
+import queue
+import threading
+from collections import deque
+import urllib.request
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+import numpy as np
+
+from numpy_inference import load_saved_model
+
+# Prices option quotes with a saved model over HTTP on localhost. Concurrent requests are coalesced
+# into micro-batches, so that many small requests share one pass through the network.
+#
+#   python pricing_server.py serve <model.npz|model.h5> [port]
+#   python pricing_server.py bench [url] [clients] [requests per client] [quotes per request]
+#
+# A request is a POST to /price with either a single quote {"days": 30, "moneyness": 1.02, ...}
+# or {"quotes": [...]} holding several such quotes, or lists of the features in the model's order.
+# The response holds {"price": [...], "delta": [...]}, one value per quote. A GET lists the features.
+
+default_port = 8642
+
+
+def load_pricing_model(path):
+    model = load_saved_model(path)
+    if not model.features:
+        # full_models always take days and moneyness as their first two inputs
+        input_dim = model.kernels[0].shape[0]
+        model.features = ['days', 'moneyness'] + ['input_{}'.format(i) for i in range(2, input_dim)]
+    return model
+
+
+class MicroBatcher:
+    """
+    Collects the quotes of concurrent requests for up to max_delay seconds or max_batch_size quotes,
+    and prices them together in a background thread
+    """
+    def __init__(self, model, max_batch_size=4096, max_delay=0.002):
+        self.model = model
+        self.max_batch_size = max_batch_size
+        self.max_delay = max_delay
+        self.requests = queue.Queue()
+        self.batch_sizes = deque(maxlen=1000)  # sizes of the most recent batches, reported by GET
+        thread = threading.Thread(target=self.run, daemon=True)
+        thread.start()
+
+    def price(self, features):
+        request = {'features': features, 'done': threading.Event()}
+        self.requests.put(request)
+        request['done'].wait()
+        if 'error' in request:
+            raise request['error']
+        return request['price'], request['delta']
+
+    def run(self):
+        while True:
+            batch = [self.requests.get()]
+            size = len(batch[0]['features'])
+            deadline = time.perf_counter() + self.max_delay
+            while size < self.max_batch_size:
+                try:
+                    request = self.requests.get(timeout=max(deadline - time.perf_counter(), 0))
+                except queue.Empty:
+                    break
+                batch.append(request)
+                size += len(request['features'])
+            self.batch_sizes.append(size)
+            self.price_batch(batch)
+
+    def price_batch(self, batch):
+        try:
+            features = np.concatenate([r['features'] for r in batch])
+            if len(features) == 0:
+                price = delta = np.empty(0)  # only requests without quotes
+            else:
+                price, jacobian, _ = self.model.price_derivatives(features)
+                delta = jacobian[:, self.model.get_feature_position('moneyness')]
+            start = 0
+            for request in batch:
+                end = start + len(request['features'])
+                request['price'], request['delta'] = price[start:end], delta[start:end]
+                start = end
+        except Exception as error:
+            for request in batch:
+                request['error'] = error
+        for request in batch:
+            request['done'].set()
+
+
+def parse_quotes(body, features):
+    quotes = body['quotes'] if 'quotes' in body else [body]
+    if quotes and isinstance(quotes[0], dict):
+        quotes = [[quote[feature] for feature in features] for quote in quotes]
+    quotes = np.array(quotes, dtype=np.float64).reshape(-1, len(features))
+    return quotes
+
+
+class PricingHandler(BaseHTTPRequestHandler):
+    batcher = None
+
+    def send_json(self, content):
+        response = json.dumps(content).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(response)))
+        self.end_headers()
+        self.wfile.write(response)
+
+    def do_GET(self):
+        # The features expected in every quote, in the order of the model's inputs, and how well requests are batched
+        batch_sizes = list(self.batcher.batch_sizes)
+        self.send_json({'features': self.batcher.model.features,
+                        'recent_batches': len(batch_sizes),
+                        'mean_batch_size': float(np.mean(batch_sizes)) if batch_sizes else None,
+                        'max_batch_size': max(batch_sizes, default=None)})
+
+    def do_POST(self):
+        if self.path != '/price':
+            self.send_error(404)
+            return
+        try:
+            body = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+            quotes = parse_quotes(body, self.batcher.model.features)
+        except (ValueError, KeyError, TypeError) as error:
+            self.send_error(400, str(error))
+            return
+        try:
+            price, delta = self.batcher.price(quotes)
+        except Exception as error:
+            self.send_error(500, str(error))
+            return
+        self.send_json({'price': price.tolist(), 'delta': delta.tolist()})
+
+    def log_message(self, format, *args):
+        pass  # one line per request would dominate the latency
+
+
+def serve(model_path, port=default_port):
+    model = load_pricing_model(model_path)
+    PricingHandler.batcher = MicroBatcher(model)
+    server = ThreadingHTTPServer(('127.0.0.1', port), PricingHandler)
+    print('Pricing with {} ({}) on http://127.0.0.1:{}/price'.format(model_path, ', '.join(model.features), port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+def post_quotes(url, quotes):
+    request = urllib.request.Request(url, data=json.dumps({'quotes': quotes}).encode(),
+                                     headers={'Content-Type': 'application/json'})
+    with urllib.request.urlopen(request) as response:
+        return json.loads(response.read())
+
+
+def bench(url='http://127.0.0.1:{}/price'.format(default_port), clients=8, requests_per_client=200,
+          quotes_per_request=1):
+    """
+    Load generator, every client sends its requests one after the other
+    """
+    random_state = np.random.RandomState(0)
+    quotes = [{'days': float(days), 'moneyness': float(moneyness)}
+              for days, moneyness in zip(random_state.randint(5, 365, quotes_per_request),
+                                         random_state.uniform(0.8, 1.2, quotes_per_request))]
+    # Features the model needs beyond days and moneyness are set to 0
+    with urllib.request.urlopen(url) as response:
+        features = json.loads(response.read())['features']
+    quotes = [dict({feature: 0.0 for feature in features}, **quote) for quote in quotes]
+    latencies = []
+
+    def client():
+        for _ in range(requests_per_client):
+            start = time.perf_counter()
+            post_quotes(url, quotes)
+            latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    threads = [threading.Thread(target=client) for _ in range(clients)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    duration = time.perf_counter() - start
+
+    latencies = np.array(latencies) * 1000
+    print('{} requests of {} quotes in {:.2f}s: {:.0f} requests/s, {:.0f} quotes/s'.format(
+        len(latencies), quotes_per_request, duration, len(latencies) / duration,
+        len(latencies) * quotes_per_request / duration))
+    print('latency ms: p50 {:.2f}, p95 {:.2f}, p99 {:.2f}, max {:.2f}'.format(
+        *np.percentile(latencies, [50, 95, 99, 100])))
+    with urllib.request.urlopen(url) as response:
+        batching = json.loads(response.read())
+    print('last {recent_batches} batches: mean size {mean_batch_size:.1f}, max size {max_batch_size}'.format(
+        **batching))
+
+
+if __name__ == '__main__':
+    command = sys.argv[1] if len(sys.argv) > 1 else 'serve'
+    if command == 'serve':
+        serve(sys.argv[2], int(sys.argv[3]) if len(sys.argv) > 3 else default_port)
+    elif command == 'bench':
+        arguments = sys.argv[2:]
+        bench(*(arguments[:1] + [int(argument) for argument in arguments[1:]]))
+    else:
+        raise ValueError("command must be either 'serve' or 'bench'")
@@ -0,0 +1,178 @@
+import sys
+import sqlite3
+from contextlib import contextmanager
+import numpy as np
+import pandas as pd
+from datetime import datetime, timedelta
+
+from config import paths
+
+# Every finished model (RunData) and Black Scholes benchmark (BSRunData) is appended as one row
+# to a SQLite file, which replaces re-reading and rewriting the results workbooks after every run.
+# The workbooks can still be produced for reporting with 'python results_store.py export'.
+
+index_columns = {
+    'RunData': ['runID', 'model_name', 'stock', 'dt_start'],
+    'BSRunData': ['runID', 'vol_proxy', 'stock', 'dt_start'],
+    'Models': ['stock', 'dt_start', 'feature_set', 'model_name'],
+}
+
+excel_paths = {
+    'RunData': paths['results-excel'],
+    'BSRunData': paths['results-excel-BS'],
+}
+
+
+@contextmanager
+def connect(db_path=paths['results-db']):
+    # Several workers may write at the same time, a generous timeout lets them wait for each other's locks
+    con = sqlite3.connect(db_path, timeout=120)
+    try:
+        with con:  # commits on success, rolls back on errors
+            yield con
+    finally:
+        con.close()
+
+
+def to_sql_value(value):
+    if value is None:
+        return None
+    if isinstance(value, (bool, np.bool_)):
+        return int(value)
+    if isinstance(value, np.generic):
+        value = value.item()
+    if isinstance(value, float) and np.isnan(value):
+        return None
+    if isinstance(value, (timedelta, pd.Timedelta)):
+        return value.total_seconds()
+    if isinstance(value, (datetime, pd.Timestamp)):
+        return value.isoformat(sep=' ')
+    if isinstance(value, (int, float, str)):
+        return value
+    return str(value)
+
+
+def get_table_columns(con, table):
+    return [row[1] for row in con.execute('PRAGMA table_info("{}")'.format(table))]
+
+
+def append_results(rows, table='RunData', db_path=paths['results-db']):
+    if not rows:
+        return
+    columns = list(dict.fromkeys(col for row in rows for col in row))
+    with connect(db_path) as con:
+        existing_columns = get_table_columns(con, table)
+        if not existing_columns:
+            con.execute('CREATE TABLE IF NOT EXISTS "{}" ({})'.format(
+                table, ', '.join('"{}"'.format(col) for col in columns)))
+            indexed = [col for col in index_columns.get(table, []) if col in columns]
+            if indexed:
+                con.execute('CREATE INDEX IF NOT EXISTS "{0}_index" ON "{0}" ({1})'.format(
+                    table, ', '.join('"{}"'.format(col) for col in indexed)))
+        else:
+            for col in columns:
+                if col not in existing_columns:
+                    con.execute('ALTER TABLE "{}" ADD COLUMN "{}"'.format(table, col))
+
+        query = 'INSERT INTO "{}" ({}) VALUES ({})'.format(
+            table, ', '.join('"{}"'.format(col) for col in columns), ', '.join('?' * len(columns)))
+        con.executemany(query, [[to_sql_value(row.get(col)) for col in columns] for row in rows])
+
+
+def get_excel_run_ids(table='RunData'):
+    try:
+        with pd.ExcelFile(excel_paths[table]) as reader:
+            runIDs = reader.parse('RunData')['runID'].dropna()
+    except FileNotFoundError:
+        return set()
+    return {int(runID) for runID in runIDs.unique()}
+
+
+def create_runs_table(con):
+    con.execute('CREATE TABLE IF NOT EXISTS runs (runID INTEGER PRIMARY KEY, started TEXT)')
+    if con.execute('SELECT COUNT(*) FROM runs').fetchone()[0] == 0:
+        # New runs continue numbering after the runs of the workbooks, also if they were never imported.
+        # Runs without a start time were not started from this store and are never resumed
+        for runID in sorted(get_excel_run_ids('RunData') | get_excel_run_ids('BSRunData')):
+            con.execute('INSERT OR IGNORE INTO runs (runID) VALUES (?)', (runID,))
+
+
+def start_run(db_path=paths['results-db']):
+    """
+    Reserves a new runID, also when several processes start at the same time
+    """
+    with connect(db_path) as con:
+        create_runs_table(con)
+        cursor = con.execute('INSERT INTO runs (started) VALUES (?)', (to_sql_value(datetime.now()),))
+        return cursor.lastrowid
+
+
+def get_last_run_id(db_path=paths['results-db']):
+    with connect(db_path) as con:
+        create_runs_table(con)
+        return con.execute('SELECT MAX(runID) FROM runs WHERE started IS NOT NULL').fetchone()[0]
+
+
+def get_completed_job_keys(runID, table='RunData', db_path=paths['results-db']):
+    with connect(db_path) as con:
+        if 'job_key' not in get_table_columns(con, table):
+            return set()
+        query = 'SELECT job_key FROM "{}" WHERE runID = ? AND job_key IS NOT NULL'.format(table)
+        return {row[0] for row in con.execute(query, (runID,))}
+
+
+def read_results(table='RunData', db_path=paths['results-db']):
+    with connect(db_path) as con:
+        if not get_table_columns(con, table):
+            return pd.DataFrame()
+        return pd.read_sql('SELECT * FROM "{}"'.format(table), con)
+
+
+def export_to_excel(table='RunData', db_path=paths['results-db']):
+    results = read_results(table, db_path)
+    # The workbook is replaced by the contents of the store, which must not lose runs only found in the workbook
+    missing_run_ids = get_excel_run_ids(table) - get_stored_run_ids(table, db_path)
+    if missing_run_ids:
+        raise ValueError('{} holds runs {} that are not in {}, import them first with '
+                         "'python results_store.py import'".format(excel_paths[table], sorted(missing_run_ids),
+                                                                 db_path))
+    with pd.ExcelWriter(excel_paths[table]) as writer:
+        results.to_excel(writer, 'RunData')
+
+
+def get_stored_run_ids(table='RunData', db_path=paths['results-db']):
+    with connect(db_path) as con:
+        if 'runID' not in get_table_columns(con, table):
+            return set()
+        query = 'SELECT DISTINCT runID FROM "{}" WHERE runID IS NOT NULL'.format(table)
+        return {int(row[0]) for row in con.execute(query)}
+
+
+def import_from_excel(table='RunData', db_path=paths['results-db']):
+    with pd.ExcelFile(excel_paths[table]) as reader:
+        previous_results = reader.parse('RunData', index_col=0)
+    # Runs already in the store are not imported again, importing twice must not duplicate them
+    already_stored = previous_results['runID'].isin(get_stored_run_ids(table, db_path))
+    if already_stored.any():
+        print('{} rows of runs already in {} skipped'.format(already_stored.sum(), db_path))
+    previous_results = previous_results.loc[~already_stored]
+    append_results(previous_results.to_dict('records'), table, db_path)
+
+    # New runs continue numbering after the imported ones
+    with connect(db_path) as con:
+        create_runs_table(con)
+        for runID in previous_results['runID'].dropna().unique():
+            con.execute('INSERT OR IGNORE INTO runs (runID) VALUES (?)', (int(runID),))
+
+
+if __name__ == '__main__':
+    # python results_store.py export|import
+    command = sys.argv[1] if len(sys.argv) > 1 else 'export'
+    for table in excel_paths:
+        if command == 'export':
+            export_to_excel(table)
+        elif command == 'import':
+            import_from_excel(table)
+        else:
+            raise ValueError("command must be either 'export' or 'import'")
+        print('{} {}ed'.format(table, command))
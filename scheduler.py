@@ -0,0 +1,283 @@
+import os
+import sys
+import time
+import pickle
+import socket
+import threading
+import traceback
+import multiprocessing
+from contextlib import contextmanager
+
+# A sweep can be spread over any number of nodes through a job queue on shared storage:
+#   <queue>/pending/<job_id>.pkl    job descriptors waiting for a worker
+#   <queue>/leased/<job_id>.pkl     jobs being worked on, the file's mtime is the worker's heartbeat
+#   <queue>/done/<job_id>.pkl       finished jobs
+#   <queue>/failed/<job_id>.pkl     jobs that raised an exception, together with the traceback
+#   <queue>/results/<job_id>.pkl    results not yet collected
+#   <queue>/collected/<job_id>.pkl  results already stored by 'collect'
+# Jobs are leased by renaming them from pending to leased, which is atomic, so that every
+# job goes to exactly one worker. Leases without a heartbeat for lease_timeout seconds are
+# returned to pending, e.g. after a node got pre-empted.
+#
+#   python scheduler.py enqueue <queue>   writes the sweep of the current config to the queue
+#   python scheduler.py work <queue>      trains jobs until the queue is empty, on as many nodes as wanted
+#   python scheduler.py collect <queue>   stores the results as they arrive, like perform_experiment does
+
+queue_states = ['pending', 'leased', 'done', 'failed', 'results', 'collected']
+
+
+def get_fork_context(processes):
+    """
+    Context to start the workers with, or None to stay in this process. Workers are forked so that they
+    inherit the loaded data, spawning them would re-import all of it, so platforms without fork stay serial
+    """
+    if processes > 1 and 'fork' in multiprocessing.get_all_start_methods():
+        return multiprocessing.get_context('fork')
+    return None
+
+
+def get_fork_pool(processes):
+    context = get_fork_context(processes)
+    return None if context is None else context.Pool(processes)
+
+
+def write_pickle(path, obj):
+    # Written to a temporary file first, so that readers never see a partially written file
+    temp_path = '{}.{}_{}.tmp'.format(path, socket.gethostname(), os.getpid())
+    with open(temp_path, 'wb') as f:
+        pickle.dump(obj, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(temp_path, path)
+
+
+def read_pickle(path):
+    with open(path, 'rb') as f:
+        return pickle.load(f)
+
+
+class WorkQueue:
+    def __init__(self, root, lease_timeout=1800, heartbeat_interval=60, poll_interval=10):
+        self.root = root
+        self.lease_timeout = lease_timeout
+        self.heartbeat_interval = heartbeat_interval
+        self.poll_interval = poll_interval
+        for state in queue_states:
+            os.makedirs(os.path.join(root, state), exist_ok=True)
+
+    def get_path(self, state, job_id):
+        return os.path.join(self.root, state, job_id + '.pkl')
+
+    def get_job_ids(self, state):
+        return sorted(filename[:-len('.pkl')] for filename in os.listdir(os.path.join(self.root, state))
+                      if filename.endswith('.pkl'))
+
+    def get_counts(self):
+        return {state: len(self.get_job_ids(state)) for state in queue_states}
+
+    def put(self, job_id, job):
+        """
+        Adds a job unless a job with that id is already known to the queue
+        """
+        if any(os.path.exists(self.get_path(state, job_id)) for state in ['pending', 'leased', 'done', 'failed']):
+            return False
+        write_pickle(self.get_path('pending', job_id), job)
+        return True
+
+    def requeue_expired_leases(self):
+        now = time.time()
+        for job_id in self.get_job_ids('leased'):
+            try:
+                expired = now - os.path.getmtime(self.get_path('leased', job_id)) > self.lease_timeout
+                if expired:
+                    os.rename(self.get_path('leased', job_id), self.get_path('pending', job_id))
+                    print('Requeued {} after its lease expired'.format(job_id), flush=True)
+            except FileNotFoundError:
+                pass  # finished or requeued by someone else in the meantime
+
+    def lease(self):
+        """
+        Returns (job_id, job) of a pending job, which now belongs to this worker, or None
+        """
+        self.requeue_expired_leases()
+        for job_id in self.get_job_ids('pending'):
+            try:
+                # The mtime is refreshed first, a lease must not look expired right after the rename
+                os.utime(self.get_path('pending', job_id))
+                os.rename(self.get_path('pending', job_id), self.get_path('leased', job_id))
+            except FileNotFoundError:
+                continue  # another worker was faster
+
+            if os.path.exists(self.get_path('results', job_id)) or \
+                    os.path.exists(self.get_path('collected', job_id)):
+                # Requeued after a lease expired, but its first worker finished it after all
+                self.release(job_id, 'done')
+                continue
+            return job_id, read_pickle(self.get_path('leased', job_id))
+        return None
+
+    def heartbeat(self, job_id):
+        try:
+            os.utime(self.get_path('leased', job_id))
+        except FileNotFoundError:
+            pass  # the lease expired, the result is still accepted in complete
+
+    @contextmanager
+    def keep_alive(self, job_id):
+        stopped = threading.Event()
+
+        def beat():
+            while not stopped.wait(self.heartbeat_interval):
+                self.heartbeat(job_id)
+
+        heart = threading.Thread(target=beat, daemon=True)
+        heart.start()
+        try:
+            yield
+        finally:
+            stopped.set()
+            heart.join()
+
+    def release(self, job_id, state):
+        try:
+            os.rename(self.get_path('leased', job_id), self.get_path(state, job_id))
+        except FileNotFoundError:
+            pass
+
+    def complete(self, job_id, result):
+        write_pickle(self.get_path('results', job_id), result)
+        self.release(job_id, 'done')
+
+    def fail(self, job_id, job, error):
+        write_pickle(self.get_path('failed', job_id), (job, error))
+        try:
+            os.remove(self.get_path('leased', job_id))
+        except FileNotFoundError:
+            pass
+
+    def is_drained(self):
+        return not self.get_job_ids('pending') and not self.get_job_ids('leased')
+
+    def work(self, function):
+        """
+        Runs function(job) for leased jobs until no job is pending or leased anymore.
+        While other workers still hold leases this worker waits, to take over the ones that expire
+        """
+        jobs_done = 0
+        while True:
+            leased = self.lease()
+            if leased is None:
+                if self.is_drained():
+                    return jobs_done
+                time.sleep(self.poll_interval)
+                continue
+
+            job_id, job = leased
+            try:
+                with self.keep_alive(job_id):
+                    result = function(job)
+            except Exception:
+                error = traceback.format_exc()
+                print(error, flush=True)
+                self.fail(job_id, job, error)
+                continue
+            self.complete(job_id, result)
+            jobs_done += 1
+
+    def collect(self):
+        """
+        Yields (job_id, result) of finished jobs as they arrive, until the queue is drained.
+        A result is marked as collected once the consumer asks for the next one
+        """
+        while True:
+            drained = self.is_drained()
+            job_ids = self.get_job_ids('results')
+            for job_id in job_ids:
+                yield job_id, read_pickle(self.get_path('results', job_id))
+                os.rename(self.get_path('results', job_id), self.get_path('collected', job_id))
+            if drained and not job_ids:
+                return
+            if not job_ids:
+                time.sleep(self.poll_interval)
+
+
+def get_job_manifest_path(root):
+    return os.path.join(root, 'jobs.pkl')
+
+
+def get_run_path(root):
+    return os.path.join(root, 'run.pkl')
+
+
+def enqueue(root):
+    """
+    The first enqueue reserves the run of the queue, later ones add the jobs still missing to that same run
+    """
+    from config import results_backend
+    from main_processor import get_run, get_training_jobs
+    from results_store import get_completed_job_keys
+
+    if results_backend != 'sqlite':
+        raise ValueError("the scheduler stores its results with results_backend = 'sqlite'")
+    queue = WorkQueue(root)
+    if os.path.exists(get_run_path(root)):
+        runID = read_pickle(get_run_path(root))
+        completed_job_keys = get_completed_job_keys(runID, 'RunData')
+        known_jobs = read_pickle(get_job_manifest_path(root))
+    else:
+        runID, completed_job_keys, _ = get_run()
+        write_pickle(get_run_path(root), runID)
+        known_jobs = []
+
+    jobs = list(get_training_jobs(runID, completed_job_keys))
+    added = sum(queue.put(job.job_key, job) for job in jobs)
+    # collect expects every job of the run that is not stored yet, also those of earlier enqueues
+    manifest = {job.job_key: job for job in known_jobs if job.job_key not in completed_job_keys}
+    manifest.update((job.job_key, job) for job in jobs)
+    write_pickle(get_job_manifest_path(root), list(manifest.values()))
+    print('Run {}: {} jobs added to {}'.format(runID, added, root))
+
+
+def work(root):
+    from main_processor import train_job
+
+    jobs_done = WorkQueue(root).work(train_job)
+    print('{} on {}: {} jobs done'.format(os.getpid(), socket.gethostname(), jobs_done))
+
+
+def work_on_node(root):
+    from config import training_workers
+    from main_processor import init_training_process
+
+    init_training_process()
+    context = get_fork_context(training_workers)
+    if context is not None:
+        workers = [context.Process(target=work, args=(root,)) for _ in range(training_workers)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+    else:
+        work(root)
+
+
+def collect(root):
+    from async_writer import AsyncWriter
+    from main_processor import collect_training_results, get_cache_report
+
+    jobs = read_pickle(get_job_manifest_path(root))
+    queue = WorkQueue(root)
+    with AsyncWriter() as writer:
+        _, _, cache_counters = collect_training_results(jobs, (result for _, result in queue.collect()), writer)
+    print(queue.get_counts())
+    print(get_cache_report(cache_counters))
+
+
+if __name__ == '__main__':
+    command, queue_root = sys.argv[1], sys.argv[2]
+    if command == 'enqueue':
+        enqueue(queue_root)
+    elif command == 'work':
+        work_on_node(queue_root)
+    elif command == 'collect':
+        collect(queue_root)
+    else:
+        raise ValueError("command must be one of 'enqueue', 'work', 'collect'")
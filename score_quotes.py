@@ -0,0 +1,68 @@
+import os
+import sys
+import time
+import pandas as pd
+
+from numpy_inference import load_saved_model
+
+# Prices a file of option quotes with a saved model, chunk by chunk, so that memory use does not depend
+# on the size of the file. The fitted scalers saved next to the model are applied as in training.
+#
+#   python score_quotes.py <quotes.csv> <output.csv> <model.h5|model.npz> [chunk size]
+#   python score_quotes.py <quotes.csv> <output.csv> stock=10107 feature_set=3 ...
+#
+# The second form takes the most recently trained registered model matching the conditions.
+# Every quote needs the model's features, the output holds the quotes together with their
+# prediction (as scaled_option_price) and calculated_delta (derivative with respect to moneyness).
+
+default_chunk_size = 100000
+
+
+def find_model_path(arguments):
+    from model_registry import find_models, parse_conditions
+    conditions = parse_conditions(arguments)
+    models = find_models(**conditions)
+    if models.empty:
+        raise KeyError('No registered model matches {}'.format(conditions))
+    return models['file_path'].iloc[0]
+
+
+def score_quotes(input_path, output_path, model, chunk_size=default_chunk_size):
+    # Written to a temporary file first, an interrupted run leaves no partial output behind
+    temp_path = output_path + '.tmp'
+    moneyness_position = model.get_feature_position('moneyness')
+    scored = 0
+    start = time.perf_counter()
+    with open(temp_path, 'w', newline='') as output:
+        for chunk in pd.read_csv(input_path, chunksize=chunk_size):
+            missing_features = set(model.features) - set(chunk.columns)
+            if missing_features:
+                raise KeyError('{} lacks the features {}'.format(input_path, missing_features))
+            price, jacobian, _ = model.price_derivatives(chunk[model.features])
+            chunk['prediction'] = price
+            chunk['calculated_delta'] = jacobian[:, moneyness_position]
+            chunk.to_csv(output, header=scored == 0, index=False)
+            scored += len(chunk)
+            print('{} quotes scored'.format(scored), end='\r', flush=True)
+    os.replace(temp_path, output_path)
+    duration = time.perf_counter() - start
+    print('{} quotes scored in {:.1f}s, {:.0f} quotes/s'.format(scored, duration, scored / max(duration, 1e-9)))
+    return scored
+
+
+if __name__ == '__main__':
+    input_path, output_path = sys.argv[1:3]
+    arguments = sys.argv[3:]
+    chunk_size = default_chunk_size
+    if '=' in arguments[0]:
+        model_path = find_model_path(arguments)
+    else:
+        model_path = arguments[0]
+        if len(arguments) > 1:
+            chunk_size = int(arguments[1])
+
+    model = load_saved_model(model_path)
+    if not model.features:
+        raise ValueError('{} was saved without its features, they are needed to read the quotes'.format(model_path))
+    print('Scoring {} with {}'.format(input_path, model_path))
+    score_quotes(input_path, output_path, model, chunk_size)
@@ -0,0 +1,74 @@
+import numpy as np
+import pytest
+
+pytest.importorskip('tensorflow')
+pytest.importorskip('keras')
+
+from keras.layers import Dense
+
+import models
+from models import full_model, ensemble_model, export_ensemble_member, StackedDense
+
+# A member of an ensemble_model has to take the same gradient step as a full_model trained alone on the same
+# batch, whatever the data of the other members and their padded rows of weight 0
+
+architecture = dict(input_dim=3, num_layers=3, nodes_per_layer=8, loss='mse', activation='relu', optimizer='sgd')
+
+
+@pytest.fixture(autouse=True)
+def without_model_diagrams(monkeypatch):
+    monkeypatch.setattr(models, 'plot_model', lambda *args, **kwargs: None)
+
+
+def set_member_weights(ensemble, member, model):
+    dense_layers = [layer for layer in model.layers if isinstance(layer, Dense)]
+    stacked_layers = [layer for layer in ensemble.layers if isinstance(layer, StackedDense)]
+    for dense_layer, stacked_layer in zip(dense_layers, stacked_layers):
+        kernel, bias = stacked_layer.get_weights()
+        kernel[member], bias[member] = dense_layer.get_weights()
+        stacked_layer.set_weights([kernel, bias])
+
+
+@pytest.mark.parametrize('optimizer', ['sgd', 'adam'])
+def test_member_takes_the_gradient_step_of_a_standalone_model(optimizer):
+    random_state = np.random.RandomState(0)
+    rows, members, member = 32, 3, 1
+    X = random_state.uniform(0.5, 1.5, size=(rows, 3))
+    Y = random_state.uniform(0.1, 0.5, size=(rows, 1))
+
+    model = full_model(**dict(architecture, optimizer=optimizer))
+    ensemble = ensemble_model(members, **dict(architecture, optimizer=optimizer))
+    set_member_weights(ensemble, member, model)
+
+    # The other members train on other data, the first one with padded rows
+    X_stacked = random_state.uniform(0.5, 1.5, size=(rows, members, 3))
+    Y_stacked = np.stack([random_state.uniform(0.1, 0.5, size=(rows, members)), np.ones((rows, members))], axis=-1)
+    X_stacked[:, member] = X
+    Y_stacked[:, member, 0] = Y[:, 0]
+    Y_stacked[20:, 0, 1] = 0
+
+    for _ in range(3):
+        model.train_on_batch(X, Y)
+        ensemble.train_on_batch(X_stacked, Y_stacked)
+
+    exported = export_ensemble_member(ensemble, member, **architecture)
+    for expected, actual in zip(model.get_weights(), exported.get_weights()):
+        np.testing.assert_allclose(actual, expected, rtol=1e-4, atol=1e-6)
+
+
+def test_member_losses_leave_out_the_padded_rows():
+    random_state = np.random.RandomState(1)
+    rows, members = 32, 2
+    ensemble = ensemble_model(members, **architecture)
+    X_stacked = random_state.uniform(0.5, 1.5, size=(rows, members, 3))
+    Y_stacked = np.stack([random_state.uniform(0.1, 0.5, size=(rows, members)), np.ones((rows, members))], axis=-1)
+    Y_stacked[20:, 0, 1] = 0
+    # The padded rows would add a large error
+    Y_stacked[20:, 0, 0] = 100
+
+    loss, first_member_loss, second_member_loss = ensemble.test_on_batch(X_stacked, Y_stacked)
+    for member, member_loss, member_rows in [(0, first_member_loss, 20), (1, second_member_loss, rows)]:
+        exported = export_ensemble_member(ensemble, member, **architecture)
+        expected = exported.test_on_batch(X_stacked[:member_rows, member], Y_stacked[:member_rows, member, :1])[0]
+        np.testing.assert_allclose(member_loss, expected, rtol=1e-5)
+    np.testing.assert_allclose(loss, first_member_loss + second_member_loss, rtol=1e-5)
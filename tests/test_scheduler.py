@@ -0,0 +1,122 @@
+import os
+import time
+import uuid
+import multiprocessing
+
+import pytest
+
+from scheduler import WorkQueue, read_pickle
+
+# Several worker processes share one queue directory, as the workers of several nodes would
+
+pytestmark = pytest.mark.skipif('fork' not in multiprocessing.get_all_start_methods(),
+                                reason='the workers are forked')
+
+
+def get_queue(root, lease_timeout=30):
+    return WorkQueue(str(root), lease_timeout=lease_timeout, heartbeat_interval=0.05, poll_interval=0.05)
+
+
+def square(job):
+    n, runs_dir = job
+    # Every execution leaves a file behind, so that jobs run twice are detected
+    open(os.path.join(runs_dir, '{}_{}'.format(n, uuid.uuid4().hex)), 'w').close()
+    if n == 13:
+        raise ValueError('unlucky number')
+    time.sleep(0.01)
+    return n * n
+
+
+def work(root):
+    get_queue(root).work(square)
+
+
+def run_workers(root, count=4):
+    context = multiprocessing.get_context('fork')
+    workers = [context.Process(target=work, args=(str(root),)) for _ in range(count)]
+    for worker in workers:
+        worker.start()
+    return workers
+
+
+def put_jobs(queue, runs_dir, numbers):
+    os.makedirs(str(runs_dir), exist_ok=True)
+    for n in numbers:
+        assert queue.put('job_{:03d}'.format(n), (n, str(runs_dir)))
+
+
+def get_runs_per_job(runs_dir):
+    runs = {}
+    for filename in os.listdir(str(runs_dir)):
+        n = int(filename.split('_')[0])
+        runs[n] = runs.get(n, 0) + 1
+    return runs
+
+
+def test_workers_lease_every_job_exactly_once(tmp_path):
+    queue = get_queue(tmp_path / 'queue')
+    put_jobs(queue, tmp_path / 'runs', range(40))
+    for worker in run_workers(tmp_path / 'queue'):
+        worker.join()
+
+    assert get_runs_per_job(tmp_path / 'runs') == {n: 1 for n in range(40)}
+    counts = queue.get_counts()
+    assert counts['pending'] == counts['leased'] == 0
+    assert counts['done'] == 39 and counts['failed'] == 1 and counts['results'] == 39
+
+
+def test_put_ignores_known_jobs(tmp_path):
+    queue = get_queue(tmp_path / 'queue')
+    put_jobs(queue, tmp_path / 'runs', [1])
+    assert not queue.put('job_001', (1, str(tmp_path / 'runs')))
+
+
+def test_failing_job_is_recorded_with_its_traceback(tmp_path):
+    queue = get_queue(tmp_path / 'queue')
+    put_jobs(queue, tmp_path / 'runs', [12, 13, 14])
+    assert queue.work(square) == 2
+
+    assert queue.get_job_ids('failed') == ['job_013']
+    job, error = read_pickle(queue.get_path('failed', 'job_013'))
+    assert job[0] == 13 and 'unlucky number' in error
+    assert queue.is_drained()
+
+
+def test_expired_lease_is_requeued(tmp_path):
+    queue = get_queue(tmp_path / 'queue', lease_timeout=1)
+    put_jobs(queue, tmp_path / 'runs', [2, 3])
+
+    # A worker that leased a job and died without heartbeat
+    job_id, job = queue.lease()
+    assert queue.get_job_ids('leased') == [job_id]
+    old = time.time() - 10
+    os.utime(queue.get_path('leased', job_id), (old, old))
+
+    assert queue.work(square) == 2
+    assert get_runs_per_job(tmp_path / 'runs') == {2: 1, 3: 1}
+    assert sorted(queue.get_job_ids('done')) == ['job_002', 'job_003']
+
+
+def test_heartbeat_keeps_a_long_job_leased(tmp_path):
+    queue = get_queue(tmp_path / 'queue', lease_timeout=0.5)
+    put_jobs(queue, tmp_path / 'runs', [4])
+    job_id, job = queue.lease()
+    with queue.keep_alive(job_id):
+        time.sleep(1)
+        queue.requeue_expired_leases()
+        assert queue.get_job_ids('leased') == [job_id]
+
+
+def test_collect_drains_the_results_while_workers_run(tmp_path):
+    queue = get_queue(tmp_path / 'queue')
+    put_jobs(queue, tmp_path / 'runs', range(20))
+    workers = run_workers(tmp_path / 'queue', count=3)
+
+    results = dict(queue.collect())
+    for worker in workers:
+        worker.join()
+
+    assert results == {'job_{:03d}'.format(n): n * n for n in range(20) if n != 13}
+    assert queue.get_job_ids('results') == []
+    assert len(queue.get_job_ids('collected')) == 19
+    assert list(queue.collect()) == []
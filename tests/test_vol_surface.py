@@ -0,0 +1,87 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from vol_surface import bilinear_vsurface_interpolation, bilinear_vsurface_interpolation_batch
+
+# Without tied quotes bilinear_vsurface_interpolation_batch has to return exactly the volatilities of the
+# point-by-point bilinear_vsurface_interpolation. Those quote sets have distinct days and distinct
+# moneyness values, ties between quotes are tested on their own.
+
+
+def get_quotes(random_state, n):
+    return pd.DataFrame({
+        'days': random_state.choice(np.arange(5., 200.), n, replace=False),
+        'moneyness': random_state.choice(np.round(np.linspace(0.7, 1.3, 121), 3), n, replace=False),
+        'impl_volatility': random_state.uniform(0.1, 0.6, n),
+    })
+
+
+def interpolate_point_by_point(quotes, ttms, mons):
+    return np.array([bilinear_vsurface_interpolation(quotes, ttm, mon) for ttm, mon in zip(ttms, mons)])
+
+
+def assert_identical(quotes, ttms, mons):
+    expected = interpolate_point_by_point(quotes, ttms, mons)
+    actual = bilinear_vsurface_interpolation_batch(quotes, ttms, mons)
+    np.testing.assert_array_equal(actual, expected)
+
+
+@pytest.mark.parametrize('seed', range(20))
+def test_randomized_quotes(seed):
+    random_state = np.random.RandomState(seed)
+    quotes = get_quotes(random_state, random_state.randint(1, 30))
+    # Points inside and outside both ranges, and on quoted days and moneyness values
+    ttms = np.concatenate([random_state.uniform(1, 220, 40), random_state.choice(quotes.days.values, 20)])
+    mons = np.concatenate([random_state.uniform(0.6, 1.4, 40), random_state.choice(quotes.moneyness.values, 20)])
+    assert_identical(quotes, ttms, mons)
+
+
+def test_shorter_than_all_quotes_falls_back_to_the_longest_maturity():
+    # days <= ttm is empty, the later slice falls back to the quote of the longest maturity
+    quotes = get_quotes(np.random.RandomState(1), 25)
+    ttms = np.full(9, quotes.days.min() - 3)
+    mons = np.linspace(0.6, 1.4, 9)
+    assert_identical(quotes, ttms, mons)
+
+
+def test_longer_than_all_quotes_falls_back_to_the_shortest_maturity():
+    # days >= ttm is empty, the earlier slice falls back to the quote of the shortest maturity
+    quotes = get_quotes(np.random.RandomState(2), 25)
+    ttms = np.full(9, quotes.days.max() + 10)
+    mons = np.linspace(0.6, 1.4, 9)
+    assert_identical(quotes, ttms, mons)
+
+
+def test_quoted_points_use_the_equal_days_branch():
+    # On a quoted maturity both slices contain that maturity, the interpolated days are equal
+    quotes = get_quotes(np.random.RandomState(3), 25)
+    assert_identical(quotes, quotes.days.values, quotes.moneyness.values)
+    assert_identical(quotes, quotes.days.values, quotes.moneyness.values + 0.01)
+
+
+def test_equal_moneyness_is_broken_by_the_nearest_maturity():
+    quotes = pd.DataFrame({'days': [10., 30., 60.], 'moneyness': [1.0, 1.0, 1.0],
+                           'impl_volatility': [0.1, 0.3, 0.5]})
+    # The later slice holds the 10 and 30 days quotes, the 30 days one is nearer to 45 days
+    interp = bilinear_vsurface_interpolation_batch(quotes, [45.], [1.0])
+    np.testing.assert_allclose(interp, [0.4])
+    # The same holds for the higher neighbour and in any quote order
+    interp = bilinear_vsurface_interpolation_batch(quotes.iloc[::-1], [45., 45.], [0.9, 1.0])
+    np.testing.assert_allclose(interp, [0.4, 0.4])
+
+
+def test_equal_quotes_are_broken_by_quote_order():
+    quotes = pd.DataFrame({'days': [30., 30.], 'moneyness': [1.0, 1.0], 'impl_volatility': [0.2, 0.3]})
+    interp = bilinear_vsurface_interpolation_batch(quotes, [30., 30.], [1.1, 0.9])
+    np.testing.assert_array_equal(interp, [0.2, 0.2])
+
+
+def test_fallback_uses_the_nearest_moneyness_of_the_maturity():
+    # Longer than all quotes, the earlier slice falls back to the shortest maturity, of which the quote
+    # nearest in moneyness is used. Here the later slice interpolates on the same maturity, so that the
+    # equal-days branch returns the fallback volatility.
+    quotes = pd.DataFrame({'days': [30., 30., 30.], 'moneyness': [0.9, 1.1, 1.0],
+                           'impl_volatility': [0.2, 0.4, 0.3]})
+    interp = bilinear_vsurface_interpolation_batch(quotes, [100., 100.], [1.08, 0.92])
+    np.testing.assert_array_equal(interp, [0.4, 0.2])
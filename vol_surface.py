@@ -0,0 +1,140 @@
+import numpy as np
+
+# Bilinear interpolation of implied volatilities on the (days, moneyness) quotes of one trading day,
+# used for the 'surface' volatility proxy of the Black Scholes benchmark
+
+
+def bilinear_vsurface_interpolation(quotes, ttm, mon):
+
+    quotes = quotes.sort_values('days', ascending=False)
+
+    later_than = quotes.loc[quotes.days <= ttm]
+    earlier_than = quotes.loc[quotes.days >= ttm]
+
+    if len(later_than) == 0:
+        later_than = earlier_than.sort_values('days', ascending=False).iloc[0]
+        interp_later = later_than.loc[['impl_volatility', 'days']]
+    else:
+        lower_than_later = later_than.loc[later_than.moneyness <= mon]
+        higher_than_later = later_than.loc[later_than.moneyness > mon]
+
+        if len(lower_than_later) == 0:
+            higher_than_later = higher_than_later.sort_values('moneyness', ascending=False).iloc[-1]
+            interp_later = higher_than_later.loc[['impl_volatility', 'days']]
+        elif len(higher_than_later) == 0:
+            lower_than_later = lower_than_later.sort_values('moneyness', ascending=False).iloc[0]
+            interp_later = lower_than_later.loc[['impl_volatility', 'days']]
+        else:
+            lower_than_later = lower_than_later.sort_values('moneyness', ascending=False).iloc[0]
+            higher_than_later = higher_than_later.sort_values('moneyness', ascending=False).iloc[-1]
+
+            later_ratio = (mon - lower_than_later.moneyness)/(higher_than_later.moneyness - lower_than_later.moneyness)
+            interp_later = (
+                    lower_than_later.loc[['impl_volatility', 'days']] * (1 - later_ratio)
+                    + higher_than_later.loc[['impl_volatility', 'days']] * later_ratio
+            )
+    if len(earlier_than) == 0:
+        earlier_than = later_than.sort_values('days', ascending=False).iloc[-1]
+        interp_earlier = earlier_than.loc[['impl_volatility', 'days']]
+    else:
+        lower_than_earlier = earlier_than.loc[earlier_than.moneyness <= mon]
+        higher_than_earlier = earlier_than.loc[earlier_than.moneyness > mon]
+
+        if len(lower_than_earlier) == 0:
+            higher_than_earlier = higher_than_earlier.sort_values('moneyness', ascending=False).iloc[-1]
+            interp_earlier = higher_than_earlier.loc[['impl_volatility', 'days']]
+        elif len(higher_than_earlier) == 0:
+            lower_than_earlier = lower_than_earlier.sort_values('moneyness', ascending=False).iloc[0]
+            interp_earlier = lower_than_earlier.loc[['impl_volatility', 'days']]
+        else:
+            lower_than_earlier = lower_than_earlier.sort_values('moneyness', ascending=False).iloc[0]
+            higher_than_earlier = higher_than_earlier.sort_values('moneyness', ascending=False).iloc[-1]
+
+            earlier_ratio = (mon - lower_than_earlier.moneyness) / (
+                        higher_than_earlier.moneyness - lower_than_earlier.moneyness)
+            interp_earlier = (
+                    lower_than_earlier.loc[['impl_volatility', 'days']] * (1 - earlier_ratio)
+                    + higher_than_earlier.loc[['impl_volatility', 'days']] * earlier_ratio
+            )
+
+    if interp_later.days == interp_earlier.days:
+        interp = interp_earlier.impl_volatility
+    else:
+        ratio = (ttm - interp_earlier.days) / (interp_later.days - interp_earlier.days)
+        if ratio > 1:
+            interp = interp_later.impl_volatility
+        elif ratio < 0:
+            interp = interp_earlier.impl_volatility
+        else:
+            interp = interp_earlier.impl_volatility * (1 - ratio) + interp_later.impl_volatility * ratio
+
+    return interp
+
+
+def select_quote(candidates, *keys):
+    """
+    Position of the candidate quote with the smallest keys, compared in order, the first in quote order
+    on a tie of all keys. Rows without candidates get position 0
+    """
+    for key in keys[:-1]:
+        key = np.broadcast_to(key, candidates.shape)
+        best = np.where(candidates, key, np.inf).min(axis=1, keepdims=True)
+        candidates = candidates & (key == best)
+    return np.argmin(np.where(candidates, keys[-1], np.inf), axis=1)
+
+
+def bilinear_vsurface_interpolation_batch(quotes, ttms, mons):
+    """
+    Vectorized bilinear_vsurface_interpolation of many (ttm, moneyness) points on one set of quotes,
+    with the same clamping at the maturity edges and nearest moneyness fallback.
+
+    Unlike bilinear_vsurface_interpolation, whose unstable sorts pick any of several tied quotes,
+    ties are broken deterministically: of quotes with equal moneyness the one nearest to ttm in
+    maturity is used, and an empty maturity slice falls back to the quote nearest in moneyness among
+    those of the longest or shortest maturity. Further ties go to the first quote in quote order.
+    Without tied quotes both functions return exactly the same volatilities.
+    """
+    days = quotes['days'].values
+    moneyness = quotes['moneyness'].values
+    vols = quotes['impl_volatility'].values
+    ttms = np.asarray(ttms, dtype=np.float64)[:, np.newaxis]
+    mons = np.asarray(mons, dtype=np.float64)[:, np.newaxis]
+    rows = np.arange(len(ttms))
+    distance_in_days = np.abs(days - ttms)
+    distance_in_moneyness = np.abs(moneyness - mons)
+
+    def interpolate_moneyness(in_slice, fallback_days):
+        lower = in_slice & (moneyness <= mons)
+        higher = in_slice & (moneyness > mons)
+        # highest moneyness below and lowest moneyness above
+        lower_pos = select_quote(lower, -moneyness, distance_in_days)
+        higher_pos = select_quote(higher, moneyness, distance_in_days)
+        has_lower = lower[rows, lower_pos]
+        has_higher = higher[rows, higher_pos]
+
+        # ratios of points without quotes on both sides are not used, but must not warn
+        with np.errstate(divide='ignore', invalid='ignore'):
+            ratio = (mons[:, 0] - moneyness[lower_pos]) / (moneyness[higher_pos] - moneyness[lower_pos])
+            vol = vols[lower_pos] * (1 - ratio) + vols[higher_pos] * ratio
+            day = days[lower_pos] * (1 - ratio) + days[higher_pos] * ratio
+
+        vol = np.where(has_higher, np.where(has_lower, vol, vols[higher_pos]), vols[lower_pos])
+        day = np.where(has_higher, np.where(has_lower, day, days[higher_pos]), days[lower_pos])
+
+        is_empty = ~in_slice.any(axis=1)
+        fallback_pos = select_quote(np.broadcast_to(days == fallback_days, in_slice.shape), distance_in_moneyness)
+        vol = np.where(is_empty, vols[fallback_pos], vol)
+        day = np.where(is_empty, days[fallback_pos], day)
+        return vol, day
+
+    # an empty maturity slice falls back to the longest or shortest maturity respectively
+    later_vol, later_days = interpolate_moneyness(days <= ttms, days.max())
+    earlier_vol, earlier_days = interpolate_moneyness(days >= ttms, days.min())
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        ratio = (ttms[:, 0] - earlier_days) / (later_days - earlier_days)
+        interp = earlier_vol * (1 - ratio) + later_vol * ratio
+    interp = np.where(ratio > 1, later_vol, interp)
+    interp = np.where(ratio < 0, earlier_vol, interp)
+    interp = np.where(later_days == earlier_days, earlier_vol, interp)
+    return interp